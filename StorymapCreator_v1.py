@@ -1,21 +1,44 @@
 import arcpy
 import os
+import atexit
 import json
 import tempfile
 import zipfile
-import xml.etree.ElementTree as ET
 import shutil
 from datetime import datetime
+from collections import Counter
+from functools import lru_cache
+from operator import itemgetter
 import re
 import mimetypes
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice, repeat
 from typing import Dict, List, Tuple, Any, Optional, Union
-import pandas as pd
 
 from arcgis.gis import GIS
 # Resolve Image class naming conflict by using aliases
 from PIL import Image as PILImage
 from arcgis.apps.storymap import StoryMap, Image as StoryImage, Video, Audio, Text, TextStyles, Table, Code, Separator, Language
 
+# Prefer the C-based lxml parser, fall back to the standard library ElementTree
+try:
+    from lxml import etree as ET
+    # Comments and processing instructions have no string tag in lxml, drop them while parsing
+    XML_PARSER_OPTIONS = {'remove_comments': True, 'remove_pis': True, 'resolve_entities': False}
+    XML_PARSER = ET.XMLParser(**XML_PARSER_OPTIONS)
+    LXML_AVAILABLE = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    XML_PARSER_OPTIONS = {}
+    XML_PARSER = None
+    LXML_AVAILABLE = False
+
+# orjson is optional, the standard library json module is used when it is missing
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Constants for namespaces in DOCX files
 NAMESPACES = {
@@ -31,12 +54,259 @@ NAMESPACES = {
     'ind': 'http://schemas.openxmlformats.org/drawingml/2006/indicator'
 }
 
+# Precomputed qualified names and paths used for every DOCX element
+W_NS = NAMESPACES['w']
+BODY_TAG = f'{{{W_NS}}}body'
+P_TAG = f'{{{W_NS}}}p'
+TBL_TAG = f'{{{W_NS}}}tbl'
+DRAWING_TAG = f'{{{W_NS}}}drawing'
+ALT_CONTENT_TAG = f'{{{NAMESPACES["mc"]}}}AlternateContent'
+# Body-level elements handled by process_docx_body (plus the body itself)
+BODY_ELEMENT_TAGS = (BODY_TAG, P_TAG, TBL_TAG, DRAWING_TAG, ALT_CONTENT_TAG)
+RELATIONSHIP_TAG = '{http://schemas.openxmlformats.org/package/2006/relationships}Relationship'
+# Paragraph properties are direct children of w:pPr, so no descendant search is needed
+P_STYLE_XPATH = f'{{{W_NS}}}pPr/{{{W_NS}}}pStyle'
+NUM_PR_XPATH = f'{{{W_NS}}}pPr/{{{W_NS}}}numPr'
+ILVL_TAG = f'{{{W_NS}}}ilvl'
+NUM_ID_TAG = f'{{{W_NS}}}numId'
+T_TAG = f'{{{W_NS}}}t'
+TXBX_CONTENT_TAG = f'{{{W_NS}}}txbxContent'
+# Paths used by the paragraph and heading helpers
+DRAWING_XPATH = f'.//{{{W_NS}}}drawing'
+OUTLINE_LVL_XPATH = f'{{{W_NS}}}pPr/{{{W_NS}}}outlineLvl'
+R_XPATH = f'.//{{{W_NS}}}r'
+B_XPATH = f'{{{W_NS}}}rPr/{{{W_NS}}}b'
+SZ_XPATH = f'{{{W_NS}}}rPr/{{{W_NS}}}sz'
+# Paths used by the image, table and run formatting helpers
+R_NS = NAMESPACES['r']
+WP_NS = NAMESPACES['wp']
+MC_NS = NAMESPACES['mc']
+BLIP_XPATH = f'.//{{{NAMESPACES["a"]}}}blip'
+EMBED_ATTR = f'{{{R_NS}}}embed'
+LINK_ATTR = f'{{{R_NS}}}link'
+ID_ATTR = f'{{{R_NS}}}id'
+DOC_PR_XPATH = f'.//{{{WP_NS}}}docPr'
+POSITION_H_XPATH = f'.//{{{WP_NS}}}positionH'
+ALIGN_XPATH = f'.//{{{WP_NS}}}align'
+WRAP_TAGS = tuple(f'{{{WP_NS}}}{wrap_type}' for wrap_type in ('wrapSquare', 'wrapTight', 'wrapThrough', 'wrapTopBottom'))
+WRAP_XPATHS = tuple(f'.//{wrap_tag}' for wrap_tag in WRAP_TAGS)
+CHOICE_XPATH = f'.//{{{MC_NS}}}Choice'
+ALT_CONTENT_XPATH = f'.//{{{MC_NS}}}AlternateContent'
+TR_XPATH = f'.//{{{W_NS}}}tr'
+TC_XPATH = f'.//{{{W_NS}}}tc'
+P_XPATH = f'.//{{{W_NS}}}p'
+T_XPATH = f'.//{{{W_NS}}}t'
+JC_XPATH = f'{{{W_NS}}}pPr/{{{W_NS}}}jc'
+HYPERLINK_TAG = f'{{{W_NS}}}hyperlink'
+R_TAG = f'{{{W_NS}}}r'
+# Run elements checked by extract_formatted_text in a single walk over each run
+RUN_FORMATTING_TAGS = {
+    f'{{{W_NS}}}b': 'bold',
+    f'{{{W_NS}}}i': 'italic',
+    f'{{{W_NS}}}u': 'underline',
+    f'{{{W_NS}}}strike': 'strike'
+}
+# HTML tags for run formatting, innermost first so nesting stays consistent
+RUN_FORMATTING_WRAPPERS = (
+    ('sub', '<sub>', '</sub>'),
+    ('sup', '<sup>', '</sup>'),
+    ('italic', '<em>', '</em>'),
+    ('bold', '<strong>', '</strong>'),
+    ('underline', '<u>', '</u>'),
+    ('strike', '<s>', '</s>')
+)
+VERT_ALIGN_TAG = f'{{{W_NS}}}vertAlign'
+COLOR_TAG = f'{{{W_NS}}}color'
+BR_TAG = f'{{{W_NS}}}br'
+# Tags read by the run walk in extract_formatted_text, lxml filters on them in C
+RUN_WALK_TAGS = (T_TAG, *RUN_FORMATTING_TAGS, VERT_ALIGN_TAG, COLOR_TAG, BR_TAG)
+# numbering.xml elements used to resolve list formats
+ABSTRACT_NUM_TAG = f'{{{W_NS}}}abstractNum'
+NUM_TAG = f'{{{W_NS}}}num'
+LVL_TAG = f'{{{W_NS}}}lvl'
+ABSTRACT_NUM_ID_TAG = f'{{{W_NS}}}abstractNumId'
+NUM_FMT_TAG = f'{{{W_NS}}}numFmt'
+LVL_OVERRIDE_TAG = f'{{{W_NS}}}lvlOverride'
+ABSTRACT_NUM_ID_ATTR = f'{{{W_NS}}}abstractNumId'
+NUM_ID_ATTR = f'{{{W_NS}}}numId'
+ILVL_ATTR = f'{{{W_NS}}}ilvl'
+VAL_ATTR = f'{{{W_NS}}}val'
+
+# Precompiled patterns for debug file names
+UNSAFE_FILENAME_CHARS = re.compile(r'[\\/*?:"<>|]')
+MULTIPLE_UNDERSCORES = re.compile(r'__+')
+
+# Translation table escaping text placed inside HTML elements
+HTML_TEXT_ESCAPE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+
+# Precompiled patterns for ordered list detection
+ORDERED_LIST_KEYWORDS = re.compile(r'order|number', re.IGNORECASE)
+# Heading level number in style IDs such as Heading2 or Nadpis1
+STYLE_ID_DIGITS = re.compile(r'\d+')
+
+# Number formats of w:numFmt that are not bullets
+NUMBERED_LIST_FORMATS = frozenset([
+    'decimal', 'decimalZero', 'lowerLetter', 'upperLetter', 'lowerRoman', 'upperRoman',
+    'ordinal', 'cardinalText', 'ordinalText', 'decimalEnclosedParen', 'decimalEnclosedCircle'
+])
+ORDERED_LIST_MARKER = re.compile(r'^(\d+|[a-zA-Z]|[ivxIVX]+)[\.\)\:]')
+
+# StoryMap text styles for the text block types, anything else is a paragraph
+TEXT_STYLES = {
+    'bullet-list': TextStyles.BULLETLIST,
+    'numbered-list': TextStyles.NUMBERLIST,
+    'h2': TextStyles.HEADING,
+    'h3': TextStyles.HEADING2,
+    'h4': TextStyles.HEADING3,
+    'quote': TextStyles.QUOTE,
+    'large-paragraph': TextStyles.LARGEPARAGRAPH
+}
+
+# StoryMap text alignment values for the DOCX/HTML alignments
+TEXT_ALIGNMENTS = {
+    'center': 'center',
+    'right': 'end',
+    'justify': 'justify',
+    'left': 'start'
+}
+
+# StoryMap code block languages for the detected code languages
+LANGUAGE_MAPPING = {
+    'text': 'txt',
+    'python': 'py',
+    'javascript': 'js',
+    'typescript': 'ts',
+    'java': 'java',
+    'csharp': 'cs',
+    'html': 'html',
+    'css': 'css',
+    'ruby': 'rb',
+    'php': 'php',
+    'c': 'c',
+    'cpp': 'cpp',
+    'go': 'go',
+    'sql': 'sql',
+    'shell': 'sh',
+    'xml': 'xml',
+    'json': 'json',
+    'yaml': 'yaml',
+    'markdown': 'md',
+    'r': 'r',
+    'swift': 'swift',
+    'kotlin': 'kt'
+}
+
+# Precompiled patterns for code language detection, as (pattern, description) pairs.
+# Each *_PREFILTER matches text that every pattern of its check requires, so a
+# snippet without it can skip that check's pattern scans.
+SQL_PATTERNS = [
+    (re.compile(r'SELECT\s+.+?\s+FROM', re.IGNORECASE | re.MULTILINE), "SELECT FROM"),
+    (re.compile(r'INSERT\s+INTO', re.IGNORECASE | re.MULTILINE), "INSERT INTO"),
+    (re.compile(r'UPDATE\s+.+?\s+SET', re.IGNORECASE | re.MULTILINE), "UPDATE SET"),
+    (re.compile(r'CREATE\s+TABLE', re.IGNORECASE | re.MULTILINE), "CREATE TABLE"),
+    (re.compile(r'ALTER\s+TABLE', re.IGNORECASE | re.MULTILINE), "ALTER TABLE"),
+    (re.compile(r'DROP\s+TABLE', re.IGNORECASE | re.MULTILINE), "DROP TABLE"),
+    (re.compile(r'JOIN\s+\w+\s+ON', re.IGNORECASE | re.MULTILINE), "JOIN ON"),
+    (re.compile(r'WHERE\s+\w+\s*[=<>]', re.IGNORECASE | re.MULTILINE), "WHERE clause"),
+    (re.compile(r'ORDER\s+BY\s+\w+', re.IGNORECASE | re.MULTILINE), "ORDER BY"),
+    (re.compile(r'GROUP\s+BY\s+\w+', re.IGNORECASE | re.MULTILINE), "GROUP BY")
+]
+SQL_PREFILTER = re.compile(r'select|insert|update|create|alter|drop|join|where|order|group', re.IGNORECASE)
+ARCADE_PATTERNS = [
+    (re.compile(r'Geometry\(', re.IGNORECASE | re.MULTILINE), "Arcade Geometry constructor"),
+    (re.compile(r'(Feature|FeatureSet)\(', re.IGNORECASE | re.MULTILINE), "Arcade Feature constructor"),
+    (re.compile(r'When\(', re.IGNORECASE | re.MULTILINE), "Arcade When function"),
+    (re.compile(r'(Text|Count|Concatenate|IIf|IsEmpty)\(', re.IGNORECASE | re.MULTILINE), "Arcade functions"),
+    (re.compile(r'\$feature', re.IGNORECASE | re.MULTILINE), "Arcade feature reference"),
+    (re.compile(r'\$map', re.IGNORECASE | re.MULTILINE), "Arcade map reference"),
+    (re.compile(r'//.*$', re.IGNORECASE | re.MULTILINE), "Arcade comment")
+]
+ARCADE_PREFILTER = re.compile(r'\(|\$|//')
+PYTHON_PATTERNS = [
+    (re.compile(r'\bdef\s+\w+\s*\(', re.IGNORECASE | re.MULTILINE), "Function definition"),
+    (re.compile(r'\bclass\s+\w+\s*:', re.IGNORECASE | re.MULTILINE), "Class definition"),
+    (re.compile(r'import\s+[\w.]+', re.IGNORECASE | re.MULTILINE), "Import statement"),
+    (re.compile(r'from\s+[\w.]+\s+import', re.IGNORECASE | re.MULTILINE), "From import"),
+    (re.compile(r'if\s+__name__\s*==\s*[\'"]__main__[\'"]', re.IGNORECASE | re.MULTILINE), "Main block"),
+    (re.compile(r'arcpy\.\w+', re.IGNORECASE | re.MULTILINE), "ArcPy call"),
+    (re.compile(r'#.*?$', re.IGNORECASE | re.MULTILINE), "Python comment")
+]
+PYTHON_PREFILTER = re.compile(r'def|class|import|__main__|arcpy|#', re.IGNORECASE)
+CSHARP_PATTERNS = [
+    (re.compile(r'using\s+System;', re.IGNORECASE | re.MULTILINE), "Using System"),
+    (re.compile(r'namespace\s+\w+', re.IGNORECASE | re.MULTILINE), "Namespace declaration"),
+    (re.compile(r'(public|private|protected)\s+(class|interface)', re.IGNORECASE | re.MULTILINE), "Class/interface declaration"),
+    (re.compile(r'(public|private|protected)\s+\w+\s+\w+\s*\(', re.IGNORECASE | re.MULTILINE), "Method declaration"),
+    (re.compile(r'Console\.(Write|WriteLine)', re.IGNORECASE | re.MULTILINE), "Console output")
+]
+CSHARP_PREFILTER = re.compile(r'using|namespace|public|private|protected|console', re.IGNORECASE)
+JS_PATTERNS = [
+    (re.compile(r'function\s+\w+\s*\(', re.IGNORECASE | re.MULTILINE), "Function declaration"),
+    (re.compile(r'(const|let|var)\s+\w+\s*=', re.IGNORECASE | re.MULTILINE), "Variable declaration"),
+    (re.compile(r'=>', re.IGNORECASE | re.MULTILINE), "Arrow function"),
+    (re.compile(r'console\.(log|warn|error)', re.IGNORECASE | re.MULTILINE), "Console statement"),
+    (re.compile(r'document\.get(Element|ElementsByTagName)', re.IGNORECASE | re.MULTILINE), "DOM manipulation"),
+    (re.compile(r'window\.\w+', re.IGNORECASE | re.MULTILINE), "Window object"),
+    (re.compile(r'new\s+\w+\(', re.IGNORECASE | re.MULTILINE), "Constructor call")
+]
+TS_PATTERNS = [
+    (re.compile(r'interface\s+\w+', re.IGNORECASE | re.MULTILINE), "Interface"),
+    (re.compile(r'type\s+\w+\s*=', re.IGNORECASE | re.MULTILINE), "Type definition"),
+    (re.compile(r':\s*\w+[\[\]<>]*(\s*=|\))', re.IGNORECASE | re.MULTILINE), "Type annotation"),
+    (re.compile(r'<\w+>[\(\[]', re.IGNORECASE | re.MULTILINE), "Generic"),
+    (re.compile(r'as\s+\w+', re.IGNORECASE | re.MULTILINE), "Type assertion")
+]
+JS_PREFILTER = re.compile(r'function|const|let|var|=>|console|document|window|new|interface|type|:|<|as', re.IGNORECASE)
+CSS_PATTERNS = [
+    (re.compile(r'[\w-]+\s*:\s*[^;]+;', re.IGNORECASE), "Property:value"),
+    (re.compile(r'\.\w+[\w-]*\s*\{', re.IGNORECASE), "Class selector"),
+    (re.compile(r'#\w+[\w-]*\s*\{', re.IGNORECASE), "ID selector"),
+    (re.compile(r'@(media|keyframes|import|font-face)', re.IGNORECASE), "CSS at-rule"),
+    (re.compile(r'(margin|padding|color|background|font|display):', re.IGNORECASE), "Common CSS property")
+]
+HTML_PATTERNS = [
+    (re.compile(r'<!DOCTYPE\s+html', re.IGNORECASE), "HTML doctype"),
+    (re.compile(r'<html>|<html\s+', re.IGNORECASE), "HTML root tag"),
+    (re.compile(r'<(div|span|p|a|img|h[1-6])(\s+[^>]*)?>', re.IGNORECASE), "Common HTML tag")
+]
+# JSX/TSX markup inside JavaScript or TypeScript
+JSX_ELEMENT_PATTERN = re.compile(r'<\w+(\s+\w+=["\'].+?["\'])*>')
+# HTML tags and attributes counted by the HTML check
+HTML_TAG_PATTERN = re.compile(r'</?[a-z][a-z0-9]*\b[^>]*>', re.IGNORECASE)
+HTML_ATTR_PATTERN = re.compile(r'\s+(href|src|alt|class|id|style)=["\'"][^\'"]*["\']', re.IGNORECASE)
+# Words compared against the language keyword sets
+KEYWORD_WORD_PATTERN = re.compile(r'\b(\w+)\b')
+# Keywords scored by the keyword fallback, in tie-breaking order
+LANGUAGE_KEYWORDS = {
+    'py': frozenset(['def', 'import', 'class', 'self', 'None', 'True', 'False', 'if', 'elif', 'else', 'for', 'in', 'try', 'except']),
+    'js': frozenset(['function', 'const', 'let', 'var', 'return', 'true', 'false', 'null', 'undefined', 'this', 'new']),
+    'sql': frozenset(['select', 'from', 'where', 'insert', 'update', 'delete', 'create', 'drop', 'alter', 'join']),
+    'cs': frozenset(['using', 'namespace', 'public', 'private', 'class', 'void', 'string', 'int', 'bool']),
+    'html': frozenset(['div', 'span', 'class', 'id', 'style', 'href', 'src']),
+    'css': frozenset(['margin', 'padding', 'color', 'background', 'width', 'height', 'font']),
+    'arcade': frozenset(['when', 'feature', 'geometry', 'text', 'count', 'iif'])
+}
+
 # Global debug settings
+LEVEL_PRIORITY = {"none": 0, "basic": 1, "full": 2}
 DEBUG_LEVEL = "none"  # Default debug level
+DEBUG_LEVEL_INT = 0  # LEVEL_PRIORITY value of DEBUG_LEVEL, compared on every log call
 DEBUG_OUTPUT_FOLDER = None
 LOG_FILE_PATH = None
+LOG_FILE_HANDLE = None  # Kept open for the whole run when debug level is full
 JSON_FILE_PATH = None
 
+# Shared HTTP session for direct portal REST calls, reuses pooled connections
+HTTP_SESSION = requests.Session()
+atexit.register(HTTP_SESSION.close)
+
+# Number of threads extracting DOCX media files in the background
+MEDIA_EXTRACTION_WORKERS = 8
+
+# Debug messages are sent to ArcGIS Pro in batches, each arcpy call has a fixed overhead
+LOG_MESSAGE_BUFFER = []
+LOG_MESSAGE_BATCH_SIZE = 256
+
 def main():
     """Main function that orchestrates the entire process."""
     try:
@@ -69,25 +339,18 @@ def main():
         gis = connect_to_portal(credentials)
         
         # Parse input file
-        log_message(f"Parsing content file: {content_file}", "none")
+        log_message("Parsing content file: %s", "none", content_file)
         content_blocks = parse_content_file(content_file)
         
         # Log summary of parsed blocks
         if isinstance(content_blocks, tuple) and len(content_blocks) == 2:
             blocks, temp_dir = content_blocks
-            log_message(f"Parsed {len(blocks)} content blocks", "none")
         else:
             blocks = content_blocks
-            log_message(f"Parsed {len(blocks)} content blocks", "none")
+        log_message("Parsed %s content blocks", "none", len(blocks))
         
         # Count block types for summary
-        block_counts = {}
-        for block in blocks:
-            block_type = block.get('type', 'unknown')
-            if block_type in block_counts:
-                block_counts[block_type] += 1
-            else:
-                block_counts[block_type] = 1
+        block_counts = Counter(block.get('type', 'unknown') for block in blocks)
         
         log_message(f"Content block summary: {', '.join([f'{count} {type}(s)' for type, count in block_counts.items()])}", "none")
         
@@ -116,35 +379,39 @@ def main():
             edit_url = f"{portal_url}/apps/storymaps/stories/{storymap_item.id}/edit"
             view_url = f"{portal_url}/apps/storymaps/stories/{storymap_item.id}"
             
-        log_message(f"StoryMap created successfully!", "none")
-        log_message(f"Edit URL: {edit_url}", "none")
-        log_message(f"View URL: {view_url}", "none")
+        log_message("StoryMap created successfully!", "none")
+        log_message("Edit URL: %s", "none", edit_url)
+        log_message("View URL: %s", "none", view_url)
         
         # If debug is full, save the StoryMap JSON to a file
         if DEBUG_LEVEL == "full" and JSON_FILE_PATH:
             storymap_data = storymap_item.get_data()
             save_storymap_json(storymap_data, JSON_FILE_PATH)
-            log_message(f"StoryMap JSON saved to: {JSON_FILE_PATH}", "none")
-            log_message(f"Debug log saved to: {LOG_FILE_PATH}", "none")
+            log_message("StoryMap JSON saved to: %s", "none", JSON_FILE_PATH)
+            log_message("Debug log saved to: %s", "none", LOG_FILE_PATH)
             
         return storymap_item
         
     except Exception as e:
-        log_message(f"An error occurred: {str(e)}", "none", is_error=True)
+        log_message("An error occurred: %s", "none", e, is_error=True)
         import traceback
         log_message(traceback.format_exc(), "basic", is_error=True)
         raise e
+    finally:
+        flush_log_messages()
+        close_log_file()
 
 
 def initialize_debug_settings(credentials, storymap_title):
     """Initialize debug settings from credentials dictionary."""
-    global DEBUG_LEVEL, DEBUG_OUTPUT_FOLDER, LOG_FILE_PATH, JSON_FILE_PATH
+    global DEBUG_LEVEL, DEBUG_LEVEL_INT, DEBUG_OUTPUT_FOLDER, LOG_FILE_PATH, LOG_FILE_HANDLE, JSON_FILE_PATH
     
     # Set debug level from credentials
     DEBUG_LEVEL = credentials.get('debug', "none")
-    if DEBUG_LEVEL not in ["none", "basic", "full"]:
-        log_message(f"Invalid debug level '{DEBUG_LEVEL}', defaulting to 'none'", "none", is_warning=True)
+    if DEBUG_LEVEL not in LEVEL_PRIORITY:
+        log_message("Invalid debug level '%s', defaulting to 'none'", "none", DEBUG_LEVEL, is_warning=True)
         DEBUG_LEVEL = "none"
+    DEBUG_LEVEL_INT = LEVEL_PRIORITY[DEBUG_LEVEL]
     
     # If debug level is full, set up log and JSON file paths
     if DEBUG_LEVEL == "full":
@@ -158,25 +425,26 @@ def initialize_debug_settings(credentials, storymap_title):
         if not os.path.exists(DEBUG_OUTPUT_FOLDER):
             try:
                 os.makedirs(DEBUG_OUTPUT_FOLDER)
-                log_message(f"Created debug output folder: {DEBUG_OUTPUT_FOLDER}", "basic")
+                log_message("Created debug output folder: %s", "basic", DEBUG_OUTPUT_FOLDER)
             except Exception as e:
-                log_message(f"Failed to create debug output folder: {str(e)}", "none", is_warning=True)
+                log_message("Failed to create debug output folder: %s", "none", e, is_warning=True)
                 DEBUG_OUTPUT_FOLDER = tempfile.gettempdir()
-                log_message(f"Using temp directory instead: {DEBUG_OUTPUT_FOLDER}", "none", is_warning=True)
+                log_message("Using temp directory instead: %s", "none", DEBUG_OUTPUT_FOLDER, is_warning=True)
         
         # Create log and JSON file paths
         base_filename = create_safe_filename(storymap_title)
         LOG_FILE_PATH, JSON_FILE_PATH = generate_debug_file_paths(base_filename, DEBUG_OUTPUT_FOLDER)
         
-        # Initialize log file with header
-        with open(LOG_FILE_PATH, 'w', encoding='utf-8') as log_file:
-            log_file.write(f"=== StoryMap Creator Debug Log ===\n")
-            log_file.write(f"Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            log_file.write(f"StoryMap Title: {storymap_title}\n")
-            log_file.write(f"Debug Level: {DEBUG_LEVEL}\n")
-            log_file.write(f"='='='='='='='='='='='='='='='='='='='='=\n\n")
+        # Initialize log file with header and keep it open for the rest of the run
+        close_log_file()
+        LOG_FILE_HANDLE = open(LOG_FILE_PATH, 'w', encoding='utf-8', buffering=1 << 16)
+        LOG_FILE_HANDLE.write(f"=== StoryMap Creator Debug Log ===\n")
+        LOG_FILE_HANDLE.write(f"Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+        LOG_FILE_HANDLE.write(f"StoryMap Title: {storymap_title}\n")
+        LOG_FILE_HANDLE.write(f"Debug Level: {DEBUG_LEVEL}\n")
+        LOG_FILE_HANDLE.write(f"='='='='='='='='='='='='='='='='='='='='=\n\n")
     
-    log_message(f"Debug level set to: {DEBUG_LEVEL}", "basic")
+    log_message("Debug level set to: %s", "basic", DEBUG_LEVEL)
 
 
 def create_safe_filename(title):
@@ -185,9 +453,9 @@ def create_safe_filename(title):
         return "storymap"
     
     # Replace spaces with underscores and remove unsafe characters
-    safe_title = re.sub(r'[\\/*?:"<>|]', '', title.strip())
+    safe_title = UNSAFE_FILENAME_CHARS.sub('', title.strip())
     safe_title = safe_title.replace(' ', '_')
-    safe_title = re.sub(r'__+', '_', safe_title)  # Replace multiple underscores with single
+    safe_title = MULTIPLE_UNDERSCORES.sub('_', safe_title)  # Replace multiple underscores with single
     
     # Add date suffix
     date_suffix = datetime.now().strftime('%Y-%m-%d')
@@ -196,70 +464,122 @@ def create_safe_filename(title):
 
 def generate_debug_file_paths(base_filename, output_folder):
     """Generate unique file paths for log and JSON files."""
-    log_path = os.path.join(output_folder, f"{base_filename}.txt")
-    json_path = os.path.join(output_folder, f"{base_filename}.json")
+    # Read the folder once instead of probing each candidate name. Names are compared
+    # with normcase, so the lookup is case-insensitive on Windows like os.path.exists.
+    with os.scandir(output_folder) as entries:
+        existing = {os.path.normcase(entry.name) for entry in entries}
     
-    # Check if files already exist and add incremental numbers if needed
-    counter = 2
-    while os.path.exists(log_path) or os.path.exists(json_path):
-        log_path = os.path.join(output_folder, f"{base_filename}_{counter}.txt")
-        json_path = os.path.join(output_folder, f"{base_filename}_{counter}.json")
-        counter += 1
+    base_key = os.path.normcase(base_filename)
+    if f"{base_key}.txt" not in existing and f"{base_key}.json" not in existing:
+        return (os.path.join(output_folder, f"{base_filename}.txt"),
+                os.path.join(output_folder, f"{base_filename}.json"))
     
-    return log_path, json_path
+    # Files already exist - continue after the highest incremental number
+    numbered_pattern = re.compile(rf'^{re.escape(base_key)}_(\d+)\.(?:txt|json)$')
+    counters = [int(match.group(1)) for match in map(numbered_pattern.match, existing) if match]
+    counter = max(counters, default=1) + 1
+    
+    return (os.path.join(output_folder, f"{base_filename}_{counter}.txt"),
+            os.path.join(output_folder, f"{base_filename}_{counter}.json"))
 
 
-def log_message(message, min_level="none", is_error=False, is_warning=False):
+def log_message(message, min_level="none", *args, is_error=False, is_warning=False):
     """
     Log a message based on the debug level.
     
     Parameters:
-        message (str): The message to log
+        message (str): The message to log, or a %-style format string when args are given
         min_level (str): Minimum debug level required to show this message ("none", "basic", or "full")
+        *args: Values interpolated into message only if the message is actually logged
         is_error (bool): Whether this is an error message
         is_warning (bool): Whether this is a warning message
     """
-    # Determine if we should display the message based on debug level
-    level_priority = {"none": 0, "basic": 1, "full": 2}
-    current_level = level_priority.get(DEBUG_LEVEL, 0)
-    required_level = level_priority.get(min_level, 0)
-    
-    # Always log errors and warnings regardless of level
-    should_display = current_level >= required_level or is_error or is_warning
-    
-    if should_display:
-        # Log to ArcGIS Pro
+    # Messages above the current debug level are dropped before any I/O or formatting.
+    # Errors and warnings are always logged regardless of level.
+    required_level = LEVEL_PRIORITY.get(min_level, 0)
+    if required_level > DEBUG_LEVEL_INT and not is_error and not is_warning:
+        return
+    
+    if args:
+        message = message % args
+    
+    # Log to ArcGIS Pro - debug messages are batched, progress messages, warnings
+    # and errors are shown immediately after any buffered messages
+    if is_error or is_warning or required_level == 0:
+        flush_log_messages()
         if is_error:
             arcpy.AddError(message)
         elif is_warning:
             arcpy.AddWarning(message)
         else:
             arcpy.AddMessage(message)
+    else:
+        LOG_MESSAGE_BUFFER.append(message)
+        if len(LOG_MESSAGE_BUFFER) >= LOG_MESSAGE_BATCH_SIZE:
+            flush_log_messages()
     
     # Write to log file if debug level is full
-    if DEBUG_LEVEL == "full" and LOG_FILE_PATH:
+    if DEBUG_LEVEL == "full" and LOG_FILE_HANDLE is not None:
         try:
-            with open(LOG_FILE_PATH, 'a', encoding='utf-8') as log_file:
-                timestamp = datetime.now().strftime('%H:%M:%S')
-                prefix = ""
-                if is_error:
-                    prefix = "[ERROR] "
-                elif is_warning:
-                    prefix = "[WARNING] "
-                
-                log_file.write(f"[{timestamp}] {prefix}{message}\n")
+            timestamp = datetime.now().strftime('%H:%M:%S')
+            prefix = ""
+            if is_error:
+                prefix = "[ERROR] "
+            elif is_warning:
+                prefix = "[WARNING] "
+            
+            LOG_FILE_HANDLE.write(f"[{timestamp}] {prefix}{message}\n")
         except Exception as e:
             arcpy.AddWarning(f"Failed to write to log file: {str(e)}")
 
 
+def flush_log_messages():
+    """Send buffered debug messages to ArcGIS Pro as a single message."""
+    if LOG_MESSAGE_BUFFER:
+        arcpy.AddMessage("\n".join(LOG_MESSAGE_BUFFER))
+        LOG_MESSAGE_BUFFER.clear()
+
+
+def close_log_file():
+    """Flush and close the debug log file if it is open."""
+    global LOG_FILE_HANDLE
+    if LOG_FILE_HANDLE is not None:
+        try:
+            LOG_FILE_HANDLE.close()
+        except Exception as e:
+            arcpy.AddWarning(f"Failed to close log file: {str(e)}")
+        LOG_FILE_HANDLE = None
+
+
+# Make sure buffered log lines are written even if main() is not reached
+atexit.register(close_log_file)
+atexit.register(flush_log_messages)
+
+
+def dump_storymap_json(data, indent=True):
+    """Serialize StoryMap JSON data to UTF-8 bytes, indented or compact."""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        try:
+            # orjson returns UTF-8 bytes directly, same output as json with ensure_ascii=False
+            return orjson.dumps(data, option=option)
+        except TypeError as e:
+            log_message("orjson could not serialize StoryMap JSON, using json: %s", "full", e)
+    
+    if indent:
+        return json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8')
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
 def save_storymap_json(data, file_path):
     """Save StoryMap JSON data to a file."""
     try:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        json_bytes = dump_storymap_json(data)
+        with open(file_path, 'wb') as f:
+            f.write(json_bytes)
         return True
     except Exception as e:
-        log_message(f"Failed to save StoryMap JSON: {str(e)}", "none", is_warning=True)
+        log_message("Failed to save StoryMap JSON: %s", "none", e, is_warning=True)
         return False
 
 
@@ -308,19 +628,19 @@ def load_config(config_path):
         required_fields = ['username', 'password', 'arcgis_url']
         if not all(field in config for field in required_fields):
             missing = [field for field in required_fields if field not in config]
-            log_message(f"Config file is missing fields: {', '.join(missing)}", "none", is_warning=True)
+            log_message("Config file is missing fields: %s", "none", ', '.join(missing), is_warning=True)
             return None
         
         # Log debug settings from config
         if 'debug' in config:
-            log_message(f"Debug level found in config: {config['debug']}", "basic")
+            log_message("Debug level found in config: %s", "basic", config['debug'])
         
         if 'full_debug_output_folder' in config:
-            log_message(f"Debug output folder found in config: {config['full_debug_output_folder']}", "basic")
+            log_message("Debug output folder found in config: %s", "basic", config['full_debug_output_folder'])
             
         return config
     except Exception as e:
-        log_message(f"Error loading config file: {str(e)}", "none", is_warning=True)
+        log_message("Error loading config file: %s", "none", e, is_warning=True)
         return None
 
 
@@ -332,17 +652,17 @@ def connect_to_portal(credentials):
             credentials['username'],
             credentials['password']
         )
-        log_message(f"Connected to {credentials['arcgis_url']} as {credentials['username']}", "none")
+        log_message("Connected to %s as %s", "none", credentials['arcgis_url'], credentials['username'])
         return gis
     except Exception as e:
-        log_message(f"Failed to connect to ArcGIS portal: {str(e)}", "none", is_error=True)
+        log_message("Failed to connect to ArcGIS portal: %s", "none", e, is_error=True)
         raise
 
 
 def parse_content_file(file_path):
     """Parse content file based on its extension."""
     if not os.path.exists(file_path):
-        log_message(f"File not found: {file_path}", "none", is_error=True)
+        log_message("File not found: %s", "none", file_path, is_error=True)
         raise FileNotFoundError(f"File not found: {file_path}")
     
     extension = os.path.splitext(file_path)[1].lower()
@@ -354,38 +674,48 @@ def parse_content_file(file_path):
         log_message("Detected HTML file format", "basic")
         return parse_html(file_path)
     else:
-        log_message(f"Unsupported file type: {extension}", "none", is_error=True)
+        log_message("Unsupported file type: %s", "none", extension, is_error=True)
         raise ValueError(f"Unsupported file type: {extension}")
 
 
 def parse_html(file_path):
     """Parse HTML file and extract content blocks."""
     try:
-        from bs4 import BeautifulSoup
+        from bs4 import BeautifulSoup, FeatureNotFound, Tag
         
-        with open(file_path, 'r', encoding='utf-8') as f:
+        # Read raw bytes, the parser decodes them itself
+        with open(file_path, 'rb') as f:
             html_content = f.read()
             
-        log_message(f"HTML file size: {len(html_content)} bytes", "basic")
-        soup = BeautifulSoup(html_content, 'html.parser')
+        log_message("HTML file size: %s bytes", "basic", len(html_content))
+        
+        # Prefer the C-based lxml tree builder, html.parser is the pure-Python fallback
+        try:
+            soup = BeautifulSoup(html_content, 'lxml', from_encoding='utf-8')
+        except FeatureNotFound:
+            log_message("lxml not available, using html.parser", "basic")
+            soup = BeautifulSoup(html_content, 'html.parser', from_encoding='utf-8')
         
         blocks = []
         
         # Process paragraphs, headers, images, etc.
         log_message("Parsing HTML elements...", "basic")
-        for element in soup.body.find_all(recursive=False):
+        for element in soup.body.children:
+            # Skip whitespace and other strings between the elements
+            if not isinstance(element, Tag):
+                continue
             block = process_html_element(element)
             if block:
                 blocks.append(block)
-                log_message(f"Processed HTML element: {element.name} -> {block['type']}", "full")
+                log_message("Processed HTML element: %s -> %s", "full", element.name, block['type'])
         
-        log_message(f"HTML parsing complete. Found {len(blocks)} content blocks", "basic")
+        log_message("HTML parsing complete. Found %s content blocks", "basic", len(blocks))
         return blocks
     except ImportError:
         log_message("BeautifulSoup not installed. HTML parsing requires BeautifulSoup library.", "none", is_warning=True)
         return []
     except Exception as e:
-        log_message(f"Error parsing HTML file: {str(e)}", "none", is_error=True)
+        log_message("Error parsing HTML file: %s", "none", e, is_error=True)
         import traceback
         log_message(traceback.format_exc(), "basic", is_error=True)
         return []
@@ -398,7 +728,7 @@ def process_html_element(element):
     if not tag_name:
         return None
     
-    log_message(f"Processing HTML element: {tag_name}", "full")
+    log_message("Processing HTML element: %s", "full", tag_name)
     
     # Handle different element types
     if tag_name in ['h1', 'h2']:
@@ -408,7 +738,8 @@ def process_html_element(element):
     elif tag_name == 'h4':
         return create_text_block('h4', element.get_text())
     elif tag_name == 'p':
-        return create_text_block('paragraph', str(element))
+        # Inner HTML only - keeps inline formatting without re-serializing the <p> tag itself
+        return create_text_block('paragraph', element.decode_contents())
     elif tag_name == 'img':
         return create_image_block(
             element.get('src'),
@@ -421,24 +752,20 @@ def process_html_element(element):
         code_content = element.get_text()
         return create_code_block(code_content)
     elif tag_name in ['ul', 'ol']:
-        list_items = []
-        for li in element.find_all('li', recursive=False):
-            list_items.append(li.get_text())
+        list_items = [li.get_text() for li in element.find_all('li', recursive=False)]
         
         list_type = 'bullet-list' if tag_name == 'ul' else 'numbered-list'
         return create_text_block(list_type, '\n'.join(list_items))
     elif tag_name == 'table':
         rows = []
         for tr in element.find_all('tr', recursive=False):
-            cells = []
-            for td in tr.find_all(['td', 'th'], recursive=False):
-                cells.append(td.get_text().strip())
+            cells = [td.get_text().strip() for td in tr.find_all(['td', 'th'], recursive=False)]
             if cells:
                 rows.append(cells)
         if rows:
             return create_table_block(rows)
     
-    log_message(f"HTML element type {tag_name} not supported or empty", "full")
+    log_message("HTML element type %s not supported or empty", "full", tag_name)
     return None
 
 def parse_docx(file_path):
@@ -447,130 +774,365 @@ def parse_docx(file_path):
     temp_dir = None
     
     try:
-        # Create a persistent temporary directory
+        # Create a persistent temporary directory for the extracted media files
         temp_dir = tempfile.mkdtemp()
-        log_message(f"Created temporary directory: {temp_dir}", "full")
+        log_message("Created temporary directory: %s", "full", temp_dir)
         
-        # Extract DOCX file
+        # Read the DOCX package in place - only referenced media files are written to disk
         with zipfile.ZipFile(file_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
-            log_message("DOCX file extracted successfully", "full")
+            # Parse relationships to find images and hyperlinks
+            rels_root = ET.fromstring(zip_ref.read('word/_rels/document.xml.rels'), XML_PARSER)
+            log_message("Parsed document relationships", "full")
             
-        # Parse document.xml
-        document_path = os.path.join(temp_dir, 'word', 'document.xml')
-        tree = ET.parse(document_path)
-        root = tree.getroot()
-        log_message("Parsed document.xml", "full")
-        
-        # Parse relationships to find images and hyperlinks
-        rels_path = os.path.join(temp_dir, 'word', '_rels', 'document.xml.rels')
-        rels_tree = ET.parse(rels_path)
-        rels_root = rels_tree.getroot()
-        log_message("Parsed document relationships", "full")
-        
-        # Map relationship IDs to targets (images and hyperlinks)
-        image_rels = {}
-        hyperlink_rels = {}
-        
-        for rel in rels_root.findall('.//{*}Relationship'):
-            rel_id = rel.get('Id')
-            rel_type = rel.get('Type')
-            rel_target = rel.get('Target')
+            # Map relationship IDs to targets (images and hyperlinks)
+            image_rels = {}
+            hyperlink_rels = {}
+            
+            for rel in rels_root.iterfind(RELATIONSHIP_TAG):
+                rel_id = rel.get('Id')
+                rel_target = rel.get('Target')
+                # Relationship types are URIs ending in the kind of target, e.g. .../relationships/image.
+                # Only the last segment is compared - transitional and strict OOXML use different prefixes.
+                rel_kind = rel.get('Type', '').rpartition('/')[2]
+                
+                # Check if it's an image relationship
+                if rel_kind == 'image':
+                    image_rels[rel_id] = rel_target
+                    log_message("Found image relationship: %s -> %s", "full", rel_id, rel_target)
+                
+                # Check if it's a hyperlink relationship
+                elif rel_kind == 'hyperlink':
+                    hyperlink_rels[rel_id] = rel_target
+                    log_message("Found hyperlink relationship: %s -> %s", "full", rel_id, rel_target)
             
-            # Check if it's an image relationship
-            if 'image' in rel_type.lower():
-                image_rels[rel_id] = rel_target
-                log_message(f"Found image relationship: {rel_id} -> {rel_target}", "full")
+            log_message("Found %s image relationships and %s hyperlink relationships", "basic", len(image_rels), len(hyperlink_rels))
             
-            # Check if it's a hyperlink relationship
-            elif 'hyperlink' in rel_type.lower():
-                hyperlink_rels[rel_id] = rel_target
-                log_message(f"Found hyperlink relationship: {rel_id} -> {rel_target}", "full")
-        
-        log_message(f"Found {len(image_rels)} image relationships and {len(hyperlink_rels)} hyperlink relationships", "basic")
-        
-        # Get media files from the DOCX
-        media_files = {}
-        for rel_target in image_rels.values():
-            if rel_target.startswith('media/'):
-                # Normalize path separators
-                normalized_target = rel_target.replace('/', os.path.sep)
-                source_path = os.path.join(temp_dir, 'word', normalized_target)
+            # Media files are extracted in the background while the body is processed
+            with DocxMediaFiles(zip_ref, temp_dir, image_rels.values()) as media_files:
+                for rel_target in set(image_rels.values()):
+                    if rel_target.startswith('media/') and rel_target not in media_files.members:
+                        log_message("Media file not found in DOCX: word/%s", "basic", rel_target, is_warning=True)
                 
-                # Check if file exists and save it if it does
-                if os.path.exists(source_path):
-                    media_files[rel_target] = source_path
-                    log_message(f"Found media file: {source_path}", "full")
-                else:
-                    # Try with different path separators
-                    alt_path = os.path.join(temp_dir, 'word', rel_target)
-                    if os.path.exists(alt_path):
-                        media_files[rel_target] = alt_path
-                        log_message(f"Found media file (alt path): {alt_path}", "full")
-                    else:
-                        log_message(f"Media file not found: {source_path} or {alt_path}", "basic", is_warning=True)
-        
-        log_message(f"Found {len(media_files)} media files", "basic")
-        
-        # Process document body
-        blocks = []
-        body = root.find('.//{%s}body' % NAMESPACES['w'])
-        if body:
-            blocks = process_docx_body(body, NAMESPACES, image_rels, media_files, hyperlink_rels)
-            log_message(f"Processed document body, found {len(blocks)} content blocks", "basic")
-        else:
-            log_message("No document body found", "basic", is_warning=True)
+                log_message("Found %s media files", "basic", len(media_files.members))
+                
+                # Process document body while document.xml is being streamed
+                log_message("Streaming document.xml", "full")
+                numbering_formats = read_numbering_formats(zip_ref)
+                with zip_ref.open('word/document.xml') as document_file:
+                    body_elements = iter_docx_body(document_file)
+                    blocks = process_docx_body(body_elements, NAMESPACES, image_rels, media_files, hyperlink_rels,
+                                               numbering_formats)
+            log_message("Processed document body, found %s content blocks", "basic", len(blocks))
         
         return blocks, temp_dir
         
     except Exception as e:
-        log_message(f"Error parsing DOCX file: {str(e)}", "none", is_error=True)
+        log_message("Error parsing DOCX file: %s", "none", e, is_error=True)
         import traceback
         log_message(traceback.format_exc(), "basic", is_error=True)
         raise
     finally:
         # Don't delete the temp directory immediately, it will be cleaned up by the system later
-        pass
+        flush_log_messages()
 
 
-def process_docx_body(body, namespaces, image_rels, media_files, hyperlink_rels=None):
-    """Process the body of a DOCX document with improved caption handling."""
-    if hyperlink_rels is None:
-        hyperlink_rels = {}
+def read_numbering_formats(zip_ref):
+    """
+    Read the number format of every list level from word/numbering.xml.
+    
+    Parameters:
+        zip_ref: Open ZipFile of the DOCX package
+    
+    Returns:
+        dict: Maps num_id to a dict of level -> numFmt value (e.g. 'decimal', 'bullet')
+    """
+    try:
+        numbering_root = ET.fromstring(zip_ref.read('word/numbering.xml'), XML_PARSER)
+    except KeyError:
+        log_message("No numbering definitions in DOCX", "full")
+        return {}
+    
+    # Formats of each abstract numbering definition
+    abstract_formats = {}
+    for abstract_num in numbering_root.iterfind(ABSTRACT_NUM_TAG):
+        abstract_formats[abstract_num.get(ABSTRACT_NUM_ID_ATTR)] = read_level_formats(abstract_num)
+    
+    # Concrete numbering instances referenced by w:numId in paragraphs, with their level overrides
+    numbering_formats = {}
+    for num in numbering_root.iterfind(NUM_TAG):
+        abstract_num_id = num.find(ABSTRACT_NUM_ID_TAG)
+        if abstract_num_id is None:
+            continue
+        level_formats = dict(abstract_formats.get(abstract_num_id.get(VAL_ATTR), {}))
+        for level_override in num.iterfind(LVL_OVERRIDE_TAG):
+            level_formats.update(read_level_formats(level_override))
+        numbering_formats[num.get(NUM_ID_ATTR)] = level_formats
+    
+    log_message("Read number formats of %s lists", "full", len(numbering_formats))
+    return numbering_formats
+
+
+def read_level_formats(parent):
+    """Map the w:ilvl of each w:lvl child of a numbering element to its w:numFmt value."""
+    level_formats = {}
+    for lvl in parent.iterfind(LVL_TAG):
+        num_fmt = lvl.find(NUM_FMT_TAG)
+        if num_fmt is not None:
+            try:
+                level_formats[int(lvl.get(ILVL_ATTR, '0'))] = num_fmt.get(VAL_ATTR)
+            except ValueError:
+                continue
+    return level_formats
+
+
+class DocxMediaFiles(dict):
+    """
+    Mapping of image relationship targets (e.g. 'media/image1.png') to extracted file paths.
+    
+    The referenced media files are extracted, and their image headers read, by background
+    threads while the document body is parsed. A lookup only waits for the file it asks for.
+    Use it as a context manager so the threads are shut down once parsing is finished.
+    """
+    
+    def __init__(self, zip_ref, temp_dir, rel_targets=()):
+        super().__init__()
+        self.zip_ref = zip_ref
+        self.zip_path = zip_ref.filename
+        self.temp_dir = temp_dir
+        # Relationship targets are relative to word/, zip member names always use forward slashes
+        self.members = {name[len('word/'):] for name in zip_ref.namelist() if name.startswith('word/media/')}
+        self.pending = {}
+        self.executor = None
+        # (width, height) of each extracted image, None if PIL could not read it
+        self.dimensions = {}
+        
+        targets = [rel_target for rel_target in set(rel_targets) if rel_target in self.members]
+        if targets:
+            # Create the folder up front, concurrent extractions would race to create it
+            os.makedirs(os.path.join(temp_dir, 'word', 'media'), exist_ok=True)
+            self.executor = ThreadPoolExecutor(max_workers=min(MEDIA_EXTRACTION_WORKERS, len(targets)))
+            self.pending = {rel_target: self.executor.submit(self.extract, rel_target) for rel_target in targets}
+    
+    def extract(self, rel_target):
+        """
+        Extract one media file and read its image size.
+        
+        Runs in the worker threads, so it opens its own ZipFile handle (ZipFile is not
+        thread-safe) and does not log - errors are reported by the caller on the main thread.
+        
+        Returns:
+            tuple: (file_path, (width, height) or the exception raised while reading the size)
+        """
+        with zipfile.ZipFile(self.zip_path, 'r') as zip_ref:
+            file_path = zip_ref.extract(f"word/{rel_target}", self.temp_dir)
+        try:
+            # PIL only reads the image header to get the size
+            with PILImage.open(file_path) as img:
+                return file_path, img.size
+        except Exception as img_err:
+            return file_path, img_err
+    
+    def get_dimensions(self, rel_target):
+        """Return the (width, height) of an extracted image, or None if it could not be read."""
+        self.get(rel_target)
+        return self.dimensions.get(rel_target)
+    
+    def __missing__(self, rel_target):
+        if rel_target not in self.members:
+            raise KeyError(rel_target)
+        future = self.pending.pop(rel_target, None)
+        file_path, dimensions = future.result() if future is not None else self.extract(rel_target)
+        log_message("Extracted media file: %s", "full", file_path)
+        if isinstance(dimensions, Exception):
+            log_message("DEBUG: Error getting image dimensions: %s", "basic", str(dimensions), is_warning=True)
+            dimensions = None
+        self.dimensions[rel_target] = dimensions
+        self[rel_target] = file_path
+        return file_path
+    
+    def get(self, rel_target, default=None):
+        try:
+            return self[rel_target]
+        except KeyError:
+            return default
+    
+    def close(self):
+        """Wait for running extractions and stop the worker threads."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def iter_docx_body(document_source):
+    """
+    Stream the body-level elements of document.xml.
+    
+    Each element is yielded once it has been fully parsed and is removed from the tree
+    afterwards, so only the element being processed is kept in memory.
+    
+    Parameters:
+        document_source: Path or file object of document.xml
+    
+    Yields:
+        Element: Direct children of the w:body element in document order
+    """
+    # Image element counts are only reported in debug output, skip counting otherwise
+    count_image_elements = DEBUG_LEVEL_INT >= LEVEL_PRIORITY["basic"]
+    
+    if LXML_AVAILABLE and not count_image_elements:
+        yield from iter_docx_body_elements(document_source)
+        return
+    
+    body = None
+    body_depth = None
+    depth = 0
+    alt_content_count = 0
+    blip_count = 0
+    
+    for event, elem in ET.iterparse(document_source, events=('start', 'end'), **XML_PARSER_OPTIONS):
+        if event == 'start':
+            depth += 1
+            if body is None and elem.tag == BODY_TAG:
+                body = elem
+                body_depth = depth
+            continue
         
-    blocks = []
+        if body_depth is not None and depth > body_depth:
+            # Debug counts of elements that carry images
+            if count_image_elements:
+                if elem.tag.endswith('AlternateContent'):
+                    alt_content_count += 1
+                elif elem.tag.endswith('blip'):
+                    blip_count += 1
+            
+            if depth == body_depth + 1:
+                yield elem
+                # Drop the processed element to keep memory flat
+                body.remove(elem)
+                elem.clear()
+        elif elem is body:
+            body_depth = None
+        
+        depth -= 1
     
-    # Add debug to show namespace mapping
-    log_message(f"DEBUG: Using namespaces: {namespaces}", "basic")
+    if body is None:
+        log_message("No document body found", "basic", is_warning=True)
+        return
     
-    # Debug count all mc:AlternateContent elements
-    alt_content_elements = []
-    for elem in body.iter():
-        if elem.tag.endswith('AlternateContent'):
-            alt_content_elements.append(elem)
+    if count_image_elements:
+        log_message("DEBUG: Found %s mc:AlternateContent elements in document", "basic", alt_content_count)
+        log_message("DEBUG: Found %s blip elements in document", "basic", blip_count)
+
+
+def iter_docx_body_elements(document_source):
+    """
+    Stream the body-level elements of document.xml using lxml's tag filter.
     
-    log_message(f"DEBUG: Found {len(alt_content_elements)} mc:AlternateContent elements in document", "basic")
+    Only end events of the tags in BODY_ELEMENT_TAGS are reported by the parser, so
+    runs and text nodes never reach Python. Elements that do not sit directly in the
+    body (for example paragraphs inside table cells) are skipped and freed together
+    with their body-level ancestor.
     
-    # Debug find all images with different approaches
-    blip_elements = []
-    for elem in body.iter():
-        if elem.tag.endswith('blip'):
-            blip_elements.append(elem)
+    Parameters:
+        document_source: Path or file object of document.xml
     
-    log_message(f"DEBUG: Found {len(blip_elements)} blip elements in document", "basic")
+    Yields:
+        Element: Direct children of the w:body element handled by process_docx_body
+    """
+    body_found = False
     
-    # Track list collection and current element type
-    current_list_items = []
-    current_list_type = None
-    in_list_context = False
+    for event, elem in ET.iterparse(document_source, events=('end',), tag=BODY_ELEMENT_TAGS, **XML_PARSER_OPTIONS):
+        if elem.tag == BODY_TAG:
+            body_found = True
+            continue
+        
+        parent = elem.getparent()
+        if parent is None or parent.tag != BODY_TAG:
+            continue
+        
+        yield elem
+        # Drop the processed element and any skipped siblings before it (bookmarks, sdt, ...)
+        elem.clear()
+        while elem.getprevious() is not None:
+            del parent[0]
+        parent.remove(elem)
     
-    # Track previous element for caption association
-    previous_element_type = None
-    previous_block = None
-    pending_caption = None
+    if not body_found:
+        log_message("No document body found", "basic", is_warning=True)
+
+
+class DocxBodyState:
+    """Bookkeeping carried from one body element to the next by process_docx_body."""
+    __slots__ = ('list_items', 'list_type', 'in_list', 'previous_type', 'previous_block',
+                 'pending_caption', 'image_has_caption', 'used_image_rel_ids')
     
-    # Additional tracking variables for caption handling
-    image_has_caption = False  # Flag to track if an image already has a caption
+    def __init__(self):
+        # Track list collection and current element type
+        self.list_items = []
+        self.list_type = None
+        self.in_list = False
+        
+        # Track previous element for caption association
+        self.previous_type = None
+        self.previous_block = None
+        self.pending_caption = None
+        self.image_has_caption = False  # Flag to track if an image already has a caption
+        
+        # Image relationships already turned into image blocks
+        self.used_image_rel_ids = set()
+    
+    def flush_list(self):
+        """
+        Turn the collected list items into list blocks and reset list tracking.
+        
+        Returns:
+            list: List blocks for the collected items (empty if no list is open)
+        """
+        if not (self.in_list and self.list_items):
+            return []
+        
+        # Process list items
+        all_list_items = {'current_list': self.list_items}
+        num_id_to_type = {'current_list': self.list_type or get_predominant_list_type(self.list_items)}
+        
+        list_blocks = process_docx_lists(all_list_items, num_id_to_type)
+        
+        # Reset list tracking
+        self.list_items.clear()
+        self.list_type = None
+        self.in_list = False
+        return list_blocks
+
+
+def process_docx_body(body, namespaces, image_rels, media_files, hyperlink_rels=None, numbering_formats=None):
+    """
+    Process the body of a DOCX document with improved caption handling.
+    
+    Parameters:
+        body: The w:body element or any iterable of body-level elements (see iter_docx_body)
+        numbering_formats: Number formats of list levels (see read_numbering_formats)
+    """
+    if hyperlink_rels is None:
+        hyperlink_rels = {}
+    if numbering_formats is None:
+        numbering_formats = {}
+        
+    blocks = []
+    
+    # Add debug to show namespace mapping
+    log_message("DEBUG: Using namespaces: %s", "basic", namespaces)
+    
+    # List collection and caption tracking shared between elements
+    state = DocxBodyState()
+    # Bind hot lookups to locals once - the list is cleared in place, so the bound method stays valid
+    append_list_item = state.list_items.append
+    append_block = blocks.append
     
     # Process each paragraph-level element
     log_message("Processing DOCX body elements...", "full")
@@ -579,215 +1141,164 @@ def process_docx_body(body, namespaces, image_rels, media_files, hyperlink_rels=
     for element in body:
         try:
             element_count += 1
-            tag = element.tag.split('}')[-1]
+            element_tag = element.tag
             
-            log_message(f"Processing element {element_count}: {tag}", "full")
+            if DEBUG_LEVEL_INT >= LEVEL_PRIORITY["full"]:
+                log_message("Processing element %s: %s", "full", element_count, element_tag.split('}')[-1])
             
             # Specifically check for <mc:AlternateContent> at the top level
-            if tag.endswith('AlternateContent'):
-                log_message(f"DEBUG: Processing top-level AlternateContent element", "basic")
+            if element_tag == ALT_CONTENT_TAG:
+                log_message("DEBUG: Processing top-level AlternateContent element", "basic")
                 # Try to extract an image from this complex structure
-                choice = element.find('.//mc:Choice', namespaces)
+                choice = element.find(CHOICE_XPATH)
                 if choice is not None:
-                    drawing = choice.find('.//w:drawing', namespaces)
+                    drawing = choice.find(DRAWING_XPATH)
                     if drawing is not None:
-                        log_message(f"DEBUG: Found drawing in AlternateContent", "basic")
-                        image_block = process_docx_image(drawing, namespaces, image_rels, media_files)
+                        log_message("DEBUG: Found drawing in AlternateContent", "basic")
+                        image_block = process_docx_image(drawing, namespaces, image_rels, media_files, state.used_image_rel_ids)
                         if image_block:
-                            blocks.append(image_block)
-                            previous_element_type = 'image'
-                            previous_block = image_block
-                            image_has_caption = False  # Reset caption flag for new image
+                            append_block(image_block)
+                            state.previous_type = 'image'
+                            state.previous_block = image_block
+                            state.image_has_caption = False  # Reset caption flag for new image
                             continue
             
             # Normal element processing
-            if tag == 'p':
+            if element_tag == P_TAG:
                 # Process any pending caption first
-                if pending_caption:
-                    log_message(f"DEBUG: Processing pending caption: {pending_caption[:30]}...", "basic")
-                    if previous_block and 'caption' not in previous_block:
-                        previous_block['caption'] = pending_caption
-                        log_message(f"DEBUG: Added pending caption to previous {previous_element_type}", "basic")
+                if state.pending_caption:
+                    log_message("DEBUG: Processing pending caption: %s...", "basic", state.pending_caption[:30])
+                    if state.previous_block and 'caption' not in state.previous_block:
+                        state.previous_block['caption'] = state.pending_caption
+                        log_message("DEBUG: Added pending caption to previous %s", "basic", state.previous_type)
                         # Mark that this image has a caption
-                        if previous_element_type == 'image':
-                            image_has_caption = True
-                    pending_caption = None
+                        if state.previous_type == 'image':
+                            state.image_has_caption = True
+                    state.pending_caption = None
                 
                 # Check if paragraph is a caption for a previous element
-                style_elem = element.find('.//{%s}pStyle' % namespaces['w'])
-                style_name = style_elem.get('{%s}val' % namespaces['w']) if style_elem is not None else None
+                style_elem = element.find(P_STYLE_XPATH)
+                style_name = style_elem.get(VAL_ATTR) if style_elem is not None else None
                 
                 # Only check for captions if the previous element was an image or table
                 # and (for images) it doesn't already have a caption
-                if previous_element_type in ['image', 'table'] and (previous_element_type != 'image' or not image_has_caption):
-                    is_caption = is_caption_paragraph(element, namespaces, style_name, previous_element_type)
+                if state.previous_type in ['image', 'table'] and (state.previous_type != 'image' or not state.image_has_caption):
+                    is_caption = is_caption_paragraph(element, namespaces, style_name, state.previous_type)
                     
                     if is_caption:
                         # Extract caption text
-                        caption_text, _ = extract_formatted_text(element, namespaces, hyperlink_rels)
-                        log_message(f"DEBUG: Detected caption for {previous_element_type}: {caption_text[:30]}...", "basic")
+                        caption_text, _ = extract_formatted_text(element, namespaces, hyperlink_rels, escape_text=True)
+                        log_message("DEBUG: Detected caption for %s: %s...", "basic", state.previous_type, caption_text[:30])
                         
                         # Add caption to the last block
-                        if previous_block:
-                            previous_block['caption'] = caption_text
-                            log_message(f"DEBUG: Added caption to previous {previous_element_type}", "basic")
+                        if state.previous_block:
+                            state.previous_block['caption'] = caption_text
+                            log_message("DEBUG: Added caption to previous %s", "basic", state.previous_type)
                             # Mark that this image has a caption
-                            if previous_element_type == 'image':
-                                image_has_caption = True
+                            if state.previous_type == 'image':
+                                state.image_has_caption = True
                         else:
                             # Store caption for next element
-                            pending_caption = caption_text
-                            log_message(f"DEBUG: Stored pending caption", "basic")
+                            state.pending_caption = caption_text
+                            log_message("DEBUG: Stored pending caption", "basic")
                         continue  # Skip adding this paragraph as a separate block
                 
                 # Check if paragraph is a list item
-                list_info = get_paragraph_list_info(element, namespaces)
+                list_info = get_paragraph_list_info(element, namespaces, numbering_formats)
                 
                 if list_info['is_list_item']:
                     # Process list item
-                    log_message(f"Processing list item, level: {list_info['level']}, type: {list_info['list_type']}", "full")
+                    log_message("Processing list item, level: %s, type: %s", "full", list_info['level'], list_info['list_type'])
                     
                     # Extract text with formatting
-                    text_content, _ = extract_formatted_text(element, namespaces, hyperlink_rels)
+                    text_content, _ = extract_formatted_text(element, namespaces, hyperlink_rels, escape_text=True)
                     
                     # Get list information
                     level = list_info['level']
                     list_type = list_info['list_type']
                     
                     # Determine if this is a continuation of the current list or a new list
-                    if not in_list_context:
+                    if not state.in_list:
                         # Starting a new list
-                        in_list_context = True
-                        current_list_type = list_type if level == 0 else None
+                        state.in_list = True
+                        state.list_type = list_type if level == 0 else None
                     elif level == 0:
                         # New root level - determine if we should process the current list or continue it
-                        if current_list_type is None:
-                            current_list_type = list_type
+                        if state.list_type is None:
+                            state.list_type = list_type
                     
                     # Add item to the current list
-                    current_list_items.append({
+                    append_list_item({
                         'text': text_content,
                         'level': level,
                         'type': list_type,
                         'element_index': element_count
                     })
                     
-                    previous_element_type = 'list'
-                    previous_block = None
+                    state.previous_type = 'list'
+                    state.previous_block = None
                     
                 else:
                     # Non-list paragraph - process any collected list items
-                    if in_list_context and current_list_items:
-                        # Process the collected list
-                        log_message(f"Found non-list paragraph after list. Processing collected {len(current_list_items)} items.", "full")
-                        
-                        # Process list items
-                        all_list_items = {'current_list': current_list_items}
-                        num_id_to_type = {'current_list': current_list_type or get_predominant_list_type(current_list_items)}
-                        num_id_level_map = {'current_list': min(item['level'] for item in current_list_items)}
-                        
-                        list_blocks = process_docx_lists(
-                            all_list_items, 
-                            num_id_to_type,
-                            num_id_level_map
-                        )
-                        
-                        # Add list blocks to the main blocks
-                        blocks.extend(list_blocks)
+                    if state.in_list and state.list_items:
+                        log_message("Found non-list paragraph after list. Processing collected %s items.", "full", len(state.list_items))
+                        blocks.extend(state.flush_list())
                         log_message("Added list block to blocks list", "full")
-                        
-                        # Reset list tracking
-                        current_list_items = []
-                        current_list_type = None
-                        in_list_context = False
                     
                     # Process regular paragraph
-                    paragraph_block = process_docx_paragraph(element, namespaces, image_rels, media_files, hyperlink_rels)
+                    paragraph_block = process_docx_paragraph(element, namespaces, image_rels, media_files, hyperlink_rels, state.used_image_rel_ids)
                     if paragraph_block:
                         # Determine element type for caption detection
                         element_type = 'text'
                         if paragraph_block.get('type') == 'image':
                             element_type = 'image'
-                            image_has_caption = False  # Reset caption flag for new image
+                            state.image_has_caption = False  # Reset caption flag for new image
                             
-                        blocks.append(paragraph_block)
-                        log_message(f"Added paragraph block of type {paragraph_block.get('type')}", "full")
-                        previous_element_type = element_type
-                        previous_block = paragraph_block
+                        append_block(paragraph_block)
+                        log_message("Added paragraph block of type %s", "full", paragraph_block.get('type'))
+                        state.previous_type = element_type
+                        state.previous_block = paragraph_block
             
-            elif tag == 'tbl':
+            elif element_tag == TBL_TAG:
                 # Process any collected list items
-                if in_list_context and current_list_items:
-                    # Process the collected list
-                    log_message(f"Found table after list. Processing collected {len(current_list_items)} items.", "full")
-                    
-                    # Process list items
-                    all_list_items = {'current_list': current_list_items}
-                    num_id_to_type = {'current_list': current_list_type or get_predominant_list_type(current_list_items)}
-                    num_id_level_map = {'current_list': min(item['level'] for item in current_list_items)}
-                    
-                    list_blocks = process_docx_lists(
-                        all_list_items, 
-                        num_id_to_type,
-                        num_id_level_map
-                    )
-                    
-                    # Add list blocks to the main blocks
-                    blocks.extend(list_blocks)
+                if state.in_list and state.list_items:
+                    log_message("Found table after list. Processing collected %s items.", "full", len(state.list_items))
+                    blocks.extend(state.flush_list())
                     log_message("Added list block before table", "full")
-                    
-                    # Reset list tracking
-                    current_list_items = []
-                    current_list_type = None
-                    in_list_context = False
                 
                 # Process table
                 table_block = process_docx_table(element, namespaces, hyperlink_rels)
                 if table_block:
-                    blocks.append(table_block)
+                    append_block(table_block)
                     log_message("Added table block", "full")
-                    previous_element_type = 'table'
-                    previous_block = table_block
+                    state.previous_type = 'table'
+                    state.previous_block = table_block
             
             # Handle directly embedded drawings (images)
-            elif tag == 'drawing':
-                log_message(f"DEBUG: Processing direct drawing element", "basic")
-                image_block = process_docx_image(element, namespaces, image_rels, media_files)
+            elif element_tag == DRAWING_TAG:
+                log_message("DEBUG: Processing direct drawing element", "basic")
+                image_block = process_docx_image(element, namespaces, image_rels, media_files, state.used_image_rel_ids)
                 if image_block:
-                    blocks.append(image_block)
+                    append_block(image_block)
                     log_message("Added direct drawing block", "full")
-                    previous_element_type = 'image'
-                    previous_block = image_block
-                    image_has_caption = False  # Reset caption flag for new image
+                    state.previous_type = 'image'
+                    state.previous_block = image_block
+                    state.image_has_caption = False  # Reset caption flag for new image
             
         except Exception as elem_err:
-            log_message(f"Error processing element {element_count}: {str(elem_err)}", "basic", is_warning=True)
+            log_message("Error processing element %s: %s", "basic", element_count, str(elem_err), is_warning=True)
             import traceback
             log_message(traceback.format_exc(), "full", is_warning=True)
             continue
     
     # Process any remaining list items at the end of the document
-    if in_list_context and current_list_items:
-        # Process the collected list
-        log_message(f"End of document. Processing remaining {len(current_list_items)} list items.", "full")
-        
-        # Process list items
-        all_list_items = {'current_list': current_list_items}
-        num_id_to_type = {'current_list': current_list_type or get_predominant_list_type(current_list_items)}
-        num_id_level_map = {'current_list': min(item['level'] for item in current_list_items)}
-        
-        list_blocks = process_docx_lists(
-            all_list_items, 
-            num_id_to_type,
-            num_id_level_map
-        )
-        
-        # Add list blocks to the main blocks
-        blocks.extend(list_blocks)
+    if state.in_list and state.list_items:
+        log_message("End of document. Processing remaining %s list items.", "full", len(state.list_items))
+        blocks.extend(state.flush_list())
         log_message("Added final list block", "full")
     
     # Final summary
-    log_message(f"Processed {element_count} DOCX body elements, created {len(blocks)} content blocks", "basic")
+    log_message("Processed %s DOCX body elements, created %s content blocks", "basic", element_count, len(blocks))
     
     return blocks
 
@@ -803,388 +1314,248 @@ def get_predominant_list_type(list_items):
     Returns:
         String: The predominant list type ('bullet-list' or 'numbered-list')
     """
-    # First look at level 0 items
+    # Prefer level 0 items, count all items if there are none
     root_items = [item for item in list_items if item['level'] == 0]
-    
-    if root_items:
-        # Count types at root level
-        type_counts = {}
-        for item in root_items:
-            item_type = item.get('type', 'bullet-list')
-            type_counts[item_type] = type_counts.get(item_type, 0) + 1
-        
-        # Get the most common type
-        predominant_type = max(type_counts.items(), key=lambda x: x[1])[0]
-        log_message(f"Determined predominant list type from {len(root_items)} root items: {predominant_type}", "full")
-        return predominant_type
-    
-    # If no root items, count all items
-    type_counts = {}
-    for item in list_items:
-        item_type = item.get('type', 'bullet-list')
-        type_counts[item_type] = type_counts.get(item_type, 0) + 1
+    counted_items = root_items or list_items
     
     # Default to bullet-list if empty
-    if not type_counts:
+    if not counted_items:
         return 'bullet-list'
     
-    # Get the most common type
-    predominant_type = max(type_counts.items(), key=lambda x: x[1])[0]
-    log_message(f"Determined predominant list type from all {len(list_items)} items: {predominant_type}", "full")
+    # Most lists use a single type, return it without counting
+    first_type = counted_items[0].get('type', 'bullet-list')
+    if all(item.get('type', 'bullet-list') == first_type for item in counted_items):
+        predominant_type = first_type
+    else:
+        # Get the most common type
+        type_counts = Counter(item.get('type', 'bullet-list') for item in counted_items)
+        predominant_type = type_counts.most_common(1)[0][0]
+    
+    if root_items:
+        log_message("Determined predominant list type from %d root items: %s", "full", len(root_items), predominant_type)
+    else:
+        log_message("Determined predominant list type from all %d items: %s", "full", len(list_items), predominant_type)
     return predominant_type
 
-def group_list_items(all_list_items, element_indices=None):
+def process_docx_lists(all_list_items, num_id_to_type, num_id_level_map=None, element_indices=None):
     """
-    Group list items based on their adjacency in the document.
-    Handles mixed list types by normalizing to the type of the root items.
+    Process lists end-to-end from original items to StoryMap blocks.
+    
+    Items are grouped based on their adjacency in the document, and each group is
+    rendered to HTML as soon as it is complete. Mixed list types are normalized to
+    the type of the root items.
     
     Parameters:
         all_list_items (dict): Dictionary mapping num_id to list of items
+        num_id_to_type (dict): Dictionary mapping num_id to list type
+        num_id_level_map (dict, optional): Not used, root levels are tracked while grouping
         element_indices (dict, optional): Dictionary mapping num_id to original document positions
-                                        If None, positions are taken from items themselves
     
     Returns:
-        dict: New grouped list structure with assigned group IDs
+        list: List of blocks ready for StoryMap
     """
-    # Initialize result
-    grouped_lists = {}
-    group_counter = 0
-    
-    # Flatten all list items into a single list with their num_id and sort by element_index
-    flat_items = []
-    total_items = 0
-    
-    for num_id, items in all_list_items.items():
-        total_items += len(items)
-        for item in items:
-            flat_item = item.copy()
-            flat_item['num_id'] = num_id
-            flat_items.append(flat_item)
+    blocks = []
     
-    # Sort by element_index to ensure document order
-    flat_items.sort(key=lambda x: x.get('element_index', 0))
+    # Pair each item with its num_id instead of copying the item to store it
+    if len(all_list_items) == 1:
+        # A single list is collected in document order and shares one num_id - use it as is
+        num_id, items = next(iter(all_list_items.items()))
+        numbered_items = zip(repeat(num_id), items)
+        total_items = len(items)
+    else:
+        numbered_items = [(num_id, item) for num_id, items in all_list_items.items() for item in items]
+        
+        # Sort by element_index to ensure document order
+        numbered_items.sort(key=lambda pair: pair[1].get('element_index', 0))
+        total_items = len(numbered_items)
     
     # If no items, return empty result
-    if not flat_items:
-        return grouped_lists
+    if not total_items:
+        return blocks
     
-    log_message(f"Processing {len(flat_items)} list items from {len(all_list_items)} lists", "full")
+    log_message("Processing %s list items from %s lists", "full", total_items, len(all_list_items))
     
-    # Initialize first group
-    current_group = {
-        'type': None,
-        'document_position': flat_items[0].get('element_index', 0),
-        'items': []
-    }
+    # Items and metadata of the group being collected
+    group_items = []
+    group_type = None
+    group_position = None
+    group_min_level = None
+    # Bound once per group instead of looking up the method for every item
+    append_group_item = group_items.append
     
     # Process items
     current_num_id = None
     last_level = None
+    conversion_count = 0
+    # Type conversions are only reported in debug output, skip checking items otherwise
+    log_conversions = DEBUG_LEVEL_INT >= LEVEL_PRIORITY["basic"]
     
-    for item in flat_items:
-        num_id = item.get('num_id')
+    for num_id, item in numbered_items:
         level = item.get('level', 0)
         item_type = item.get('type', 'bullet-list')
-        item_text = item.get('text', '')[:30] + "..." if len(item.get('text', '')) > 30 else item.get('text', '')
-        
-        log_message(f"Processing item: level={level}, type={item_type}, text='{item_text}'", "full")
-        
-        # Check if we should start a new group
-        start_new_group = False
-        
-        # Start a new group if:
-        # 1. This is a level 0 item and previous group has items and it's not part of the current logical group
-        # 2. There's a significant gap in document position indicating a new list structure
-        if level == 0 and current_group['items']:
-            # If we're at a root level and the previous item was also at root level,
-            # check if this is a continuation of the same list or a new one
-            if last_level == 0:
-                # For root items, consider document position and num_id
-                if num_id != current_num_id:
-                    # Different num_id indicates a different list
-                    start_new_group = True
-                    log_message(f"Starting new group: different num_id at root level", "full")
-            else:
-                # If previous item was a nested level, don't start a new group just because 
-                # we returned to the root level - this is normal list structure
-                pass
         
-        if start_new_group:
-            # Finalize current group
-            if current_group['items']:
-                group_id = f'group_{group_counter}'
-                grouped_lists[group_id] = current_group
-                group_counter += 1
-                log_message(f"Finalized group with {len(current_group['items'])} items of type {current_group['type']}", "full")
+        if DEBUG_LEVEL_INT >= LEVEL_PRIORITY["full"]:
+            item_text = item.get('text', '')
+            if len(item_text) > 30:
+                item_text = item_text[:30] + "..."
+            log_message("Processing item: level=%s, type=%s, text='%s'", "full", level, item_type, item_text)
+        
+        # Start a new group if this root item follows another root item of a different list.
+        # Returning to the root level from a nested level is normal list structure.
+        if level == 0 and group_items and last_level == 0 and num_id != current_num_id:
+            log_message("Starting new group: different num_id at root level", "full")
+            if log_conversions:
+                conversion_count += log_list_type_conversions(group_items, group_type, len(blocks))
+            blocks.append(create_list_block(group_items, group_type, group_position, group_min_level))
+            log_message("Finalized group with %s items of type %s", "full", len(group_items), group_type)
             
-            # Start a new group
-            current_group = {
-                'type': None,
-                'document_position': item.get('element_index', 0),
-                'items': []
-            }
+            group_items = []
+            append_group_item = group_items.append
+            group_type = None
+            group_min_level = None
         
         # Update tracking variables
         current_num_id = num_id
         last_level = level
         
-        # Add item to current group with a group-specific index
-        new_item = {
-            'text': item.get('text', ''),
-            'level': level,
-            'original_type': item_type,  # Store original type for conversion logging
-            'group_index': len(current_group['items'])
-        }
-        current_group['items'].append(new_item)
+        # The first item gives the group its document position
+        if not group_items:
+            group_position = item.get('element_index', 0)
+        
+        # Items are only read while rendering, so they are grouped without copying
+        append_group_item(item)
+        # Track the root level of the group while collecting it
+        if group_min_level is None or level < group_min_level:
+            group_min_level = level
         
         # Set group type based on first level 0 item if not already set
-        if current_group['type'] is None and level == 0:
-            current_group['type'] = item_type
-            log_message(f"Set group type to {item_type} based on root item", "full")
-    
-    # Add the last group if it has items
-    if current_group['items']:
-        group_id = f'group_{group_counter}'
-        grouped_lists[group_id] = current_group
-        log_message(f"Finalized last group with {len(current_group['items'])} items of type {current_group['type']}", "full")
+        if group_type is None and level == 0:
+            group_type = item_type
+            log_message("Set group type to %s based on root item", "full", item_type)
     
-    # Count how many items have a different type than their group
-    conversion_count = 0
-    for group_id, group in grouped_lists.items():
-        group_type = group['type']
-        for item in group['items']:
-            if item.get('original_type') != group_type:
-                conversion_count += 1
-                log_message(
-                    f"Converting item in group {group_id} from {item.get('original_type')} to {group_type}: "
-                    f"level={item['level']}, text='{item['text'][:30]}...'", 
-                    "basic"
-                )
+    # Add the last group
+    if log_conversions:
+        conversion_count += log_list_type_conversions(group_items, group_type, len(blocks))
+    blocks.append(create_list_block(group_items, group_type, group_position, group_min_level))
+    log_message("Finalized last group with %s items of type %s", "full", len(group_items), group_type)
     
     # Summarize what happened
-    total_items_in_groups = sum(len(group['items']) for group in grouped_lists.values())
-    log_message(f"Grouped {total_items_in_groups} of {total_items} list items into {len(grouped_lists)} groups", "basic")
+    log_message("Grouped %s list items into %s groups", "basic", total_items, len(blocks))
     if conversion_count > 0:
-        log_message(f"Converted {conversion_count} items to match their group's type", "basic")
+        log_message("Converted %s items to match their group's type", "basic", conversion_count)
     
-    # Sanity check - make sure we didn't lose any items
-    if total_items_in_groups != total_items:
-        log_message(f"WARNING: Item count mismatch! Original={total_items}, Grouped={total_items_in_groups}", "basic", is_warning=True)
-    
-    return grouped_lists
+    # Groups are created while walking the items in document order, so the blocks are already sorted
+    return blocks
 
-def flatten_list_hierarchy(grouped_lists):
+def log_list_type_conversions(group_items, group_type, group_index):
     """
-    Flatten lists with nesting deeper than 2 levels.
-    
-    Parameters:
-        grouped_lists (dict): Grouped list structure
+    Log the items of a list group whose type differs from the group type.
     
     Returns:
-        dict: Flattened list structure preserving visual hierarchy
+        int: Number of converted items
     """
-    flattened_lists = {}
-    flattened_count = 0
-    
-    for group_id, group in grouped_lists.items():
-        # Find the minimum level in the group (root level)
-        min_level = min(item['level'] for item in group['items']) if group['items'] else 0
-        
-        # Create a new group with the same metadata
-        flattened_group = {
-            'type': group['type'],
-            'document_position': group['document_position'],
-            'items': []
-        }
-        
-        # Process each item in the group
-        for item in group['items']:
-            # Make a copy to avoid modifying the original
-            new_item = item.copy()
-            
-            # Calculate the actual depth relative to the minimum level
-            relative_level = item['level'] - min_level
-            
-            if relative_level > 1:
-                # This is a deep level (3+) that needs to be flattened
-                excess_depth = relative_level - 1  # How many levels deeper than level 2
-                prefix = "--- " * excess_depth
-                
-                # Add prefix to text content
-                original_text = new_item['text']
-                new_item['text'] = prefix + original_text
-                
-                # Set level to second level
-                new_item['level'] = min_level + 1
-                
-                flattened_count += 1
-                log_message(
-                    f"Flattened list item from level {item['level']} to level {new_item['level']} "
-                    f"with prefix: '{prefix}', Text: '{original_text[:30]}...'", 
-                    "full"
-                )
-            
-            flattened_group['items'].append(new_item)
-        
-        flattened_lists[group_id] = flattened_group
-    
-    if flattened_count > 0:
-        log_message(
-            f"Flattened {flattened_count} list items from level 3+ to level 2 with '---' prefixes", 
-            "basic"
-        )
-    
-    return flattened_lists
+    conversion_count = 0
+    for item in group_items:
+        original_type = item.get('type', 'bullet-list')
+        if original_type != group_type:
+            conversion_count += 1
+            log_message(
+                "Converting item in group group_%s from %s to %s: level=%s, text='%s...'", 
+                "basic", group_index, original_type, group_type, item['level'], item['text'][:30]
+            )
+    return conversion_count
 
-def generate_list_html(flattened_lists):
+def create_list_block(group_items, list_type, document_position, min_level):
     """
-    Generate StoryMap-compatible HTML for each list group.
+    Create a StoryMap list block from the items of one list group.
     
     Parameters:
-        flattened_lists (dict): Flattened list structure
+        group_items (list): Items of the group in document order
+        list_type (str): 'bullet-list' or 'numbered-list'
+        document_position (int): Position of the first item in the document
+        min_level (int): Lowest level in the group (root level)
     
     Returns:
-        dict: Dictionary mapping group IDs to HTML content
+        dict: Text block with the list HTML
     """
-    html_content = {}
+    # Create a text block with the appropriate list type
+    block = create_text_block(list_type, render_list_html(group_items, list_type, min_level))
     
-    for group_id, group in flattened_lists.items():
-        # Get the minimum level (root level)
-        min_level = min(item['level'] for item in group['items']) if group['items'] else 0
-        
-        # Group items by their parent
-        parent_items = []
-        current_parent = None
-        
-        # First pass: identify root items and build structure
-        for item in group['items']:
-            level = item['level']
-            text = item.get('text', '')
-            
-            if level == min_level:
-                # This is a root level item
-                current_parent = {'text': text, 'children': []}
-                parent_items.append(current_parent)
-            elif current_parent is not None:
-                # This is a child item of the current parent
-                current_parent['children'].append(text)
-        
-        # Generate the HTML
-        html = ""
-        
-        for parent in parent_items:
-            # Add parent list item
-            html += f"<li>{parent['text']}"
-            
-            # Add children if any
-            if parent['children']:
-                # Use appropriate tag based on list type
-                tag = 'ol' if group['type'] == 'numbered-list' else 'ul'
-                html += f"<{tag}>"
-                
-                # Add each child
-                for child in parent['children']:
-                    html += f"<li>{child}</li>"
-                    
-                html += f"</{tag}>"
-            
-            # Close parent list item
-            html += "</li>"
-        
-        # Store the HTML content for this group
-        html_content[group_id] = html
-        log_message(f"Generated HTML for {group['type']} with {len(group['items'])} items", "full")
+    # Add document position for proper ordering
+    block['document_position'] = document_position
     
-    return html_content
+    log_message("Generated HTML for %s with %s items", "full", list_type, len(group_items))
+    return block
 
-def process_docx_lists(all_list_items, num_id_to_type, num_id_level_map, element_indices=None):
+def render_list_html(items, list_type, min_level):
     """
-    Process lists end-to-end from original items to StoryMap blocks.
-    
-    Parameters:
-        all_list_items (dict): Dictionary mapping num_id to list of items
-        num_id_to_type (dict): Dictionary mapping num_id to list type
-        num_id_level_map (dict): Dictionary mapping num_id to minimum level
-        element_indices (dict, optional): Dictionary mapping num_id to original document positions
-    
-    Returns:
-        list: List of blocks ready for StoryMap
-    """
-    # Step 1: Group list items
-    grouped_lists = group_list_items(all_list_items, element_indices)
-    
-    # Step 2: Flatten list hierarchy
-    flattened_lists = flatten_list_hierarchy(grouped_lists)
-    
-    # Step 3: Generate HTML content
-    html_content = generate_list_html(flattened_lists)
-    
-    # Step 4: Create blocks for each list
-    blocks = []
-    
-    for group_id, group in flattened_lists.items():
-        # Get the HTML content for this group
-        html = html_content.get(group_id, "")
-        
-        # Create a text block with the appropriate list type
-        block = create_text_block(group['type'], html)
-        
-        # Add document position for proper ordering
-        block['document_position'] = group['document_position']
-        
-        blocks.append(block)
-        log_message(f"Created {group['type']} block for group {group_id}", "full")
+    Render list items as StoryMap list HTML.
     
-    # Sort blocks by document position
-    blocks.sort(key=lambda x: x.get('document_position', 0))
-    
-    return blocks
-
-def integrate_list_blocks(content_blocks, list_blocks):
-    """
-    Integrate list blocks at the correct positions in the content flow.
+    StoryMap lists have at most two levels. Items nested deeper than the second level
+    are moved to the second level with a '---' prefix per extra level, and the HTML is
+    generated in the same pass. Items below the root level that come before the first
+    root item have no parent and are left out.
     
     Parameters:
-        content_blocks (list): Existing content blocks
-        list_blocks (list): List blocks to be integrated
+        items (list): List items with 'text' and 'level' in document order
+        list_type (str): 'bullet-list' or 'numbered-list'
+        min_level (int): Lowest level in the list (root level)
     
     Returns:
-        list: Combined and properly ordered content blocks
+        str: <li> elements of the list, without the outer list container
     """
-    # If no list blocks, return original content
-    if not list_blocks:
-        return content_blocks
+    tag = 'ol' if list_type == 'numbered-list' else 'ul'
     
-    # Sort list blocks by document position
-    sorted_list_blocks = sorted(list_blocks, key=lambda x: x.get('document_position', 0))
-    
-    # Initialize result list
-    result_blocks = []
-    list_index = 0
+    html_parts = []
+    append_html = html_parts.append
+    has_parent = False
+    has_children = False
+    flattened_count = 0
     
-    # Iterate through content blocks
-    for i, block in enumerate(content_blocks):
-        # Get current position (assuming content_blocks are in order)
-        current_position = i
+    for item in items:
+        text = item.get('text', '')
+        relative_level = item['level'] - min_level
+        
+        if relative_level == 0:
+            # Close the previous root item and its children
+            if has_children:
+                append_html(f"</{tag}>")
+                has_children = False
+            if has_parent:
+                append_html("</li>")
+            append_html(f"<li>{text}")
+            has_parent = True
+            continue
         
-        # Check if we need to insert list blocks before this content block
-        while (list_index < len(sorted_list_blocks) and 
-               sorted_list_blocks[list_index].get('document_position', float('inf')) <= current_position):
-            # Add the list block
-            result_blocks.append(sorted_list_blocks[list_index])
-            list_index += 1
+        if relative_level > 1:
+            # This is a deep level (3+) that needs to be flattened to the second level
+            prefix = "--- " * (relative_level - 1)
+            flattened_count += 1
+            log_message(
+                "Flattened list item from level %s to level %s with prefix: '%s', Text: '%s...'", 
+                "full", item['level'], min_level + 1, prefix, text[:30]
+            )
+            text = prefix + text
         
-        # Add the current content block
-        result_blocks.append(block)
+        # Child items before the first root item have no parent to attach to
+        if has_parent:
+            if not has_children:
+                append_html(f"<{tag}>")
+                has_children = True
+            append_html(f"<li>{text}</li>")
     
-    # Add any remaining list blocks
-    while list_index < len(sorted_list_blocks):
-        result_blocks.append(sorted_list_blocks[list_index])
-        list_index += 1
+    if has_children:
+        append_html(f"</{tag}>")
+    if has_parent:
+        append_html("</li>")
     
-    log_message(f"Integrated {len(list_blocks)} list blocks into {len(content_blocks)} content blocks", "basic")
+    if flattened_count > 0:
+        log_message(
+            "Flattened %s list items from level 3+ to level 2 with '---' prefixes", 
+            "basic", flattened_count
+        )
     
-    return result_blocks
+    return "".join(html_parts)
 
 
 def is_caption_paragraph(paragraph, namespaces, style_name=None, previous_element_type=None):
@@ -1194,19 +1565,18 @@ def is_caption_paragraph(paragraph, namespaces, style_name=None, previous_elemen
     """
     if not style_name:
         # Try to get style from paragraph
-        style_elem = paragraph.find('.//{%s}pStyle' % namespaces['w'])
+        style_elem = paragraph.find(P_STYLE_XPATH)
         if style_elem is not None:
-            style_name = style_elem.get('{%s}val' % namespaces['w'])
+            style_name = style_elem.get(VAL_ATTR)
         
     if not style_name:
         return False
         
-    # Get text content for analysis
-    text_elements = paragraph.findall('.//{%s}t' % namespaces['w'])
-    text_content = "".join([t.text or "" for t in text_elements])
-    
-    # Log all potential caption paragraphs for debugging
-    log_message(f"DEBUG: Checking potential caption: style={style_name}, content={text_content[:30]}, prev_type={previous_element_type}", "basic")
+    # Log all potential caption paragraphs for debugging - the text is only collected for this message
+    if DEBUG_LEVEL_INT >= LEVEL_PRIORITY["basic"]:
+        text_content = get_text_content(paragraph)
+        log_message("DEBUG: Checking potential caption: style=%s, content=%s, prev_type=%s", "basic",
+                    style_name, text_content[:30], previous_element_type)
     
     # Style must explicitly be a caption style to be considered
     style_lower = style_name.lower()
@@ -1214,20 +1584,27 @@ def is_caption_paragraph(paragraph, namespaces, style_name=None, previous_elemen
     
     # If it's not explicitly a caption style, it's not a caption
     if not is_caption_style:
-        log_message(f"DEBUG: Not a caption style: {style_name}", "basic")
+        log_message("DEBUG: Not a caption style: %s", "basic", style_name)
         return False
     
     # If this is a caption style and follows an image or table, consider it a caption
     if previous_element_type in ['image', 'table'] and is_caption_style:
-        log_message(f"DEBUG: Found caption with style '{style_name}' for {previous_element_type}", "basic")
+        log_message("DEBUG: Found caption with style '%s' for %s", "basic", style_name, previous_element_type)
         return True
         
     # For all other cases, not a caption
-    log_message(f"DEBUG: Caption check result: caption_style={is_caption_style}, final=False", "basic")
+    log_message("DEBUG: Caption check result: caption_style=%s, final=False", "basic", is_caption_style)
     return False
 
 
-def get_paragraph_list_info(paragraph, namespaces):
+def get_text_content(element):
+    """Return the plain text of all w:t elements below an element."""
+    if LXML_AVAILABLE:
+        # lxml collects the text in C, without a Python loop over the elements
+        return "".join(element.itertext(T_TAG, with_tail=False))
+    return "".join([t.text or "" for t in element.iter(T_TAG)])
+
+def get_paragraph_list_info(paragraph, namespaces, numbering_formats=None):
     """
     Enhanced function to determine if a paragraph is a list item and its properties.
     More aggressively detects ordered vs. unordered lists.
@@ -1235,6 +1612,7 @@ def get_paragraph_list_info(paragraph, namespaces):
     Parameters:
         paragraph: A paragraph element from DOCX
         namespaces: Dictionary of XML namespaces
+        numbering_formats: Number formats of list levels (see read_numbering_formats)
     
     Returns:
         Dictionary with list information
@@ -1242,303 +1620,79 @@ def get_paragraph_list_info(paragraph, namespaces):
     result = {'is_list_item': False, 'level': 0, 'list_type': None, 'num_id': None}
     
     # Find numPr element (indicates a list item)
-    num_pr = paragraph.find('.//{%s}numPr' % namespaces['w'])
+    num_pr = paragraph.find(NUM_PR_XPATH)
     if num_pr is None:
         return result
     
     # Get list level (ilvl)
-    ilvl = num_pr.find('.//{%s}ilvl' % namespaces['w'])
+    ilvl = num_pr.find(ILVL_TAG)
     level = 0
     if ilvl is not None:
         try:
-            level = int(ilvl.get('{%s}val' % namespaces['w'], '0'))
+            level = int(ilvl.get(VAL_ATTR, '0'))
         except ValueError:
             level = 0
     
     # Get list ID (numId)
-    num_id = num_pr.find('.//{%s}numId' % namespaces['w'])
+    num_id = num_pr.find(NUM_ID_TAG)
     if num_id is None:
         return result
         
-    num_id_val = num_id.get('{%s}val' % namespaces['w'])
+    num_id_val = num_id.get(VAL_ATTR)
     if not num_id_val:
         return result
     
-    # Extract text content to help determine list type
-    text_elements = paragraph.findall('.//{%s}t' % namespaces['w'])
-    text_content = "".join([t.text or "" for t in text_elements])
-    text_clean = text_content.strip()
-    
     # Stronger detection for ordered lists
     is_ordered = False
     
-    # Check for explicit ordered list indicators
-    if 'order' in text_clean.lower() or 'number' in text_clean.lower():
+    # Check the number format of this list level in the numbering definitions first -
+    # it is a dict lookup, so the text only has to be read for the other lists
+    num_fmt = numbering_formats.get(num_id_val, {}).get(level) if numbering_formats else None
+    if num_fmt in NUMBERED_LIST_FORMATS:
         is_ordered = True
-        log_message(f"Detected ordered list from keywords: '{text_clean[:30]}...'", "full")
-    
-    # Check for number patterns at start of text
-    elif re.match(r'^(\d+|[a-zA-Z]|[ivxIVX]+)[\.\)\:]', text_clean):
-        is_ordered = True
-        log_message(f"Detected ordered list from pattern: '{text_clean[:30]}...'", "full")
-    
-    # Check for numbering properties in the XML
+        log_message("Detected ordered list from number format: %s", "full", num_fmt)
     else:
-        # Look for numFmt element in related numbering definition
-        # This is a simplification - in a real implementation, you'd need to trace
-        # through the numbering definitions more thoroughly
-        if 'decimal' in str(paragraph) or 'number' in str(paragraph):
-            is_ordered = True
-            log_message(f"Detected ordered list from paragraph properties", "full")
-    
-    list_type = 'numbered-list' if is_ordered else 'bullet-list'
-    
-    return {
-        'is_list_item': True, 
-        'level': level, 
-        'list_type': list_type,
-        'num_id': num_id_val
-    }
-
-def convert_list_for_storymap(list_data):
-    """
-    Convert complex nested lists to StoryMap-compatible format.
-    Ensures:
-    1. Lists have at most 2 levels (main and sub)
-    2. All items within a list are the same type
-    
-    Returns the modified list_data with appropriate warnings logged.
-    """
-    if not list_data['items'] or list_data['type'] is None:
-        return list_data
-    
-    # Find the minimum level (root level)
-    min_level = min(item['level'] for item in list_data['items'])
-    
-    # Create a proper tree structure to track relationships
-    tree = []
-    current_node = None
-    current_level = None
-    prev_level = None
-    
-    # First create a tree structure preserving parent-child relationships
-    for item in list_data['items']:
-        level = item['level']
-        
-        if level == min_level:
-            # Root level item
-            node = {'text': item['text'], 'children': [], 'level': level}
-            tree.append(node)
-            current_node = node
-            prev_level = level
-        elif level == min_level + 1 and current_node:
-            # Direct child of current root
-            child = {'text': item['text'], 'children': [], 'level': level}
-            current_node['children'].append(child)
-            current_level = child
-            prev_level = level
-        elif level > min_level + 1 and current_level:
-            # This is a deeper level that needs to be flattened
-            # Process the text to indicate its deeper nesting
-            indent = "—" * (level - (min_level + 1)) + " "
-            flattened_text = indent + item['text']
-            
-            # Add as a direct child of the current level 2 item
-            if prev_level == min_level + 1:
-                child = {'text': flattened_text, 'children': [], 'level': min_level + 1}
-                current_node['children'].append(child)
-            else:
-                # If prev_level is higher, this is a continuation of flattened items
-                # Add to the same parent as the previous item
-                child = {'text': flattened_text, 'children': [], 'level': min_level + 1}
-                current_node['children'].append(child)
-            
-            log_message(
-                f"Flattened deeply nested list item at level {level}: '{item['text'][:30]}...'", 
-                "basic", is_warning=True
-            )
-            
-            prev_level = level
-    
-    # If we have more than 2 distinct levels, log a warning
-    all_levels = set(item['level'] for item in list_data['items'])
-    if len(all_levels) > 2:
-        log_message(
-            f"List has {len(all_levels)} distinct nesting levels. StoryMap only supports 2 levels. "
-            "Deeper levels have been flattened.", 
-            "basic", is_warning=True
-        )
-    
-    # Check if there are items of a different type than the main list
-    diff_type_items = [item for item in list_data['items'] 
-                      if item.get('type') and item.get('type') != list_data['type']]
-    if diff_type_items:
-        log_message(
-            f"List contains mixed types (both ordered and unordered). "
-            f"StoryMap requires consistent list types. All items will be set to '{list_data['type']}'.", 
-            "basic", is_warning=True
-        )
-    
-    # Convert the tree back to a flattened structure with proper relationships
-    new_items = []
-    for node in tree:
-        new_items.append({'text': node['text'], 'level': node['level']})
-        for child in node['children']:
-            new_items.append({'text': child['text'], 'level': child['level']})
-    
-    list_data['items'] = new_items
-    return list_data
-
-
-def process_list_structure(list_data):
-    """
-    Process a list structure to create proper HTML for StoryMap lists.
-    
-    Ensures:
-    1. Lists are maximum 2 levels deep
-    2. All items within a list are the same type
-    3. HTML structure matches StoryMap format
-    """
-    if not list_data['items'] or list_data['type'] is None:
-        return None
-    
-    # First apply StoryMap compatibility conversion
-    list_data = convert_list_for_storymap(list_data)
-    
-    # Determine the list type
-    list_type = list_data['type']
-    log_message(f"Processing list structure of type: {list_type} with {len(list_data['items'])} items", "full")
-    
-    # Find the minimum level (root level)
-    min_level = min(item['level'] for item in list_data['items'])
-    
-    # Build the hierarchical structure
-    hierarchy = []
-    current_parent = None
-    
-    # First pass: build parent-child relationships
-    for item in list_data['items']:
-        level = item['level']
-        
-        if level == min_level:
-            # This is a root level item
-            current_parent = {'text': item['text'], 'children': []}
-            hierarchy.append(current_parent)
-        elif current_parent and level == min_level + 1:
-            # This is a direct child of the current parent
-            current_parent['children'].append(item['text'])
-    
-    # Generate the HTML according to StoryMap format
-    html = ""
-    for node in hierarchy:
-        # Start list item (no ul/ol container at root level)
-        html += f"<li>{node['text']}"
-        
-        # Add sublist if there are children
-        if node['children']:
-            # Use appropriate tag based on parent list type
-            tag = 'ol' if list_type == 'numbered-list' else 'ul'
-            html += f"<{tag}>"
-            
-            # Add child items
-            for child_text in node['children']:
-                html += f"<li>{child_text}</li>"
-            
-            # Close sublist
-            html += f"</{tag}>"
+        # Extract text content to help determine list type
+        text_clean = get_text_content(paragraph).strip()
         
-        # Close main list item
-        html += "</li>"
-    
-    log_message(f"Generated HTML for {list_type}: {html[:100]}...", "full")
-    
-    # Create the text block with the appropriate list type
-    return create_text_block(list_type, html)
-
-
-    """
-    Process a list structure to create proper HTML for StoryMap lists.
-    
-    Ensures:
-    1. Lists are maximum 2 levels deep
-    2. All items within a list are the same type
-    3. HTML structure matches StoryMap format
-    """
-    if not list_data['items'] or list_data['type'] is None:
-        return None
-    
-    # First apply StoryMap compatibility conversion
-    list_data = convert_list_for_storymap(list_data)
-    
-    # Determine the list type
-    list_type = list_data['type']
-    log_message(f"Processing list structure of type: {list_type} with {len(list_data['items'])} items", "full")
-    
-    # Find the minimum level (root level)
-    min_level = min(item['level'] for item in list_data['items'])
-    
-    # Build the hierarchical structure
-    hierarchy = []
-    current_parent = None
-    
-    # First pass: build parent-child relationships
-    for item in list_data['items']:
-        level = item['level']
-        
-        if level == min_level:
-            # This is a root level item
-            current_parent = {'text': item['text'], 'children': []}
-            hierarchy.append(current_parent)
-        elif current_parent and level == min_level + 1:
-            # This is a direct child of the current parent
-            current_parent['children'].append(item['text'])
-    
-    # Generate the HTML according to StoryMap format
-    html = ""
-    for node in hierarchy:
-        # Start list item (no ul/ol container at root level)
-        html += f"<li>{node['text']}"
-        
-        # Add sublist if there are children
-        if node['children']:
-            # Use appropriate tag based on parent list type
-            tag = 'ol' if list_type == 'numbered-list' else 'ul'
-            html += f"<{tag}>"
-            
-            # Add child items
-            for child_text in node['children']:
-                html += f"<li>{child_text}</li>"
-            
-            # Close sublist
-            html += f"</{tag}>"
+        # Check for explicit ordered list indicators
+        if ORDERED_LIST_KEYWORDS.search(text_clean):
+            is_ordered = True
+            log_message("Detected ordered list from keywords: '%s...'", "full", text_clean[:30])
         
-        # Close main list item
-        html += "</li>"
-    
-    log_message(f"Generated HTML for {list_type}: {html[:100]}...", "full")
+        # Check for number patterns at start of text
+        elif ORDERED_LIST_MARKER.match(text_clean):
+            is_ordered = True
+            log_message("Detected ordered list from pattern: '%s...'", "full", text_clean[:30])
     
-    # Create the text block with the appropriate list type
-    return create_text_block(list_type, html)
+    list_type = 'numbered-list' if is_ordered else 'bullet-list'
     
-def process_docx_paragraph(paragraph, namespaces, image_rels, media_files, hyperlink_rels=None):
+    return {
+        'is_list_item': True, 
+        'level': level, 
+        'list_type': list_type,
+        'num_id': num_id_val
+    }
+
+def process_docx_paragraph(paragraph, namespaces, image_rels, media_files, hyperlink_rels=None, used_image_rel_ids=None):
     """Process a DOCX paragraph element with language-independent heading detection."""
     if hyperlink_rels is None:
         hyperlink_rels = {}
     
     # Check for paragraph style
-    style_elem = paragraph.find('.//{%s}pStyle' % namespaces['w'])
+    style_elem = paragraph.find(P_STYLE_XPATH)
     style = None
     style_id = None
     if style_elem is not None:
-        style = style_elem.get('{%s}val' % namespaces['w'])
+        style = style_elem.get(VAL_ATTR)
         style_id = style  # Save the original style ID
-        log_message(f"Processing DOCX paragraph with style ID: {style}", "full")
+        log_message("Processing DOCX paragraph with style ID: %s", "full", style)
     
     # Check for images
-    drawing = paragraph.find('.//{%s}drawing' % namespaces['w'])
+    drawing = paragraph.find(DRAWING_XPATH)
     if drawing is not None:
         log_message("Paragraph contains drawing/image", "full")
-        return process_docx_image(drawing, namespaces, image_rels, media_files)
+        return process_docx_image(drawing, namespaces, image_rels, media_files, used_image_rel_ids)
     
     # Process text content with rich formatting
     text_tuple = extract_formatted_text(paragraph, namespaces, hyperlink_rels)
@@ -1548,7 +1702,7 @@ def process_docx_paragraph(paragraph, namespaces, image_rels, media_files, hyper
     # Skip empty paragraphs
     if not text or not text.strip():
         if alignment:
-            log_message(f"Empty paragraph with alignment: {alignment}", "full")
+            log_message("Empty paragraph with alignment: %s", "full", alignment)
             return create_text_block('paragraph', '', alignment)
         log_message("Skipping empty paragraph", "full")
         return None
@@ -1556,138 +1710,150 @@ def process_docx_paragraph(paragraph, namespaces, image_rels, media_files, hyper
     # Check outline level - this is language-independent
     outline_level = get_paragraph_outline_level(paragraph, namespaces)
     if outline_level is not None:
-        log_message(f"Found outline level: {outline_level}", "full")
+        log_message("Found outline level: %s", "full", outline_level)
         if outline_level == 0:
-            log_message(f"Created heading (h2) from outline level: {text[:30]}...", "full")
+            log_message("Created heading (h2) from outline level: %s...", "full", text[:30])
             return create_text_block('h2', text, alignment)
         elif outline_level == 1:
-            log_message(f"Created subheading (h3) from outline level: {text[:30]}...", "full")
+            log_message("Created subheading (h3) from outline level: %s...", "full", text[:30])
             return create_text_block('h3', text, alignment)
         elif outline_level == 2:
-            log_message(f"Created subheading (h4) from outline level: {text[:30]}...", "full")
+            log_message("Created subheading (h4) from outline level: %s...", "full", text[:30])
             return create_text_block('h4', text, alignment)
     
+    # Style-derived values are the same for every paragraph of a style, so they are cached
+    style_number, style_block_type = classify_paragraph_style(style_id) if style_id else (None, None)
+    
     # Check for numeric pattern in style ID (language-independent)
-    if style_id:
-        # Extract any digits from the style ID
-        digits = re.findall(r'\d+', style_id)
-        if digits:
-            heading_level = int(digits[0])
-            if heading_level == 1:
-                log_message(f"Created heading (h2) from style number: {text[:30]}...", "full")
-                return create_text_block('h2', text, alignment)
-            elif heading_level == 2:
-                log_message(f"Created subheading (h3) from style number: {text[:30]}...", "full")
-                return create_text_block('h3', text, alignment)
-            elif heading_level == 3:
-                log_message(f"Created subheading (h4) from style number: {text[:30]}...", "full")
-                return create_text_block('h4', text, alignment)
-    
-    # Check paragraph formatting attributes that suggest a heading
-    is_heading = check_heading_formatting(paragraph, namespaces)
-    if is_heading:
-        # Determine heading level based on formatting
-        font_size = get_font_size(paragraph, namespaces)
-        if font_size:
-            log_message(f"Found font size: {font_size}", "full")
-            if font_size >= 20:
-                log_message(f"Created heading (h2) from font size: {text[:30]}...", "full")
-                return create_text_block('h2', text, alignment)
-            elif font_size >= 16:
-                log_message(f"Created subheading (h3) from font size: {text[:30]}...", "full")
-                return create_text_block('h3', text, alignment)
-            elif font_size >= 14:
-                log_message(f"Created subheading (h4) from font size: {text[:30]}...", "full")
-                return create_text_block('h4', text, alignment)
+    if style_number == 1:
+        log_message("Created heading (h2) from style number: %s...", "full", text[:30])
+        return create_text_block('h2', text, alignment)
+    elif style_number == 2:
+        log_message("Created subheading (h3) from style number: %s...", "full", text[:30])
+        return create_text_block('h3', text, alignment)
+    elif style_number == 3:
+        log_message("Created subheading (h4) from style number: %s...", "full", text[:30])
+        return create_text_block('h4', text, alignment)
+    
+    # Check paragraph formatting that suggests a heading - only a large font size
+    # (14pt+) decides the level, so bold runs and spacing need not be inspected here
+    font_size = get_font_size(paragraph, namespaces)
+    if font_size:
+        log_message("Found font size: %s", "full", font_size)
+        if font_size >= 20:
+            log_message("Created heading (h2) from font size: %s...", "full", text[:30])
+            return create_text_block('h2', text, alignment)
+        elif font_size >= 16:
+            log_message("Created subheading (h3) from font size: %s...", "full", text[:30])
+            return create_text_block('h3', text, alignment)
+        elif font_size >= 14:
+            log_message("Created subheading (h4) from font size: %s...", "full", text[:30])
+            return create_text_block('h4', text, alignment)
     
     # Check other style attributes often used for headings
-    if style:
-        style_lower = style.lower()
-        # Check for common heading keywords in any language
-        if 'title' in style_lower or 'heading' in style_lower or 'nadpis' in style_lower:
-            log_message(f"Created heading (h2) from style keywords: {text[:30]}...", "full")
-            return create_text_block('h2', text, alignment)
-        
-        # Check for quote styles
-        if 'quote' in style_lower or 'citation' in style_lower:
-            log_message(f"Created quote: {text[:30]}...", "full")
-            return create_text_block('quote', text, alignment)
-        
-        # Check for code styles
-        if 'code' in style_lower or 'source' in style_lower:
-            log_message(f"Created code block: {text[:30]}...", "full")
-            return create_code_block(text)
+    if style_block_type == 'h2':
+        log_message("Created heading (h2) from style keywords: %s...", "full", text[:30])
+        return create_text_block('h2', text, alignment)
+    elif style_block_type == 'quote':
+        log_message("Created quote: %s...", "full", text[:30])
+        return create_text_block('quote', text, alignment)
+    elif style_block_type == 'code':
+        log_message("Created code block: %s...", "full", text[:30])
+        return create_code_block(text)
     
     # Check content characteristics
     if len(text.strip()) < 50:
         # Very short paragraphs might be headings
         if text.strip().isupper():
-            log_message(f"Created heading (h2) from all-caps text: {text[:30]}...", "full")
+            log_message("Created heading (h2) from all-caps text: %s...", "full", text[:30])
             return create_text_block('h2', text, alignment)
         # Short paragraphs that end without punctuation might be headings
-        if not re.search(r'[.!?]$', text.strip()):
+        if not text.strip().endswith(('.', '!', '?')):
             is_bold = check_is_bold(paragraph, namespaces)
             if is_bold:
-                log_message(f"Created heading (h3) from short bold text: {text[:30]}...", "full")
+                log_message("Created heading (h3) from short bold text: %s...", "full", text[:30])
                 return create_text_block('h3', text, alignment)
     
     # Default to paragraph
-    log_message(f"Created paragraph: {text[:30]}...", "full")
+    log_message("Created paragraph: %s...", "full", text[:30])
     return create_text_block('paragraph', text, alignment)
 
+@lru_cache(maxsize=None)
+def classify_paragraph_style(style_id):
+    """
+    Derive the heading hints carried by a paragraph style ID.
+    
+    A document uses only a handful of styles, so the result is cached per style ID
+    instead of being recomputed for every paragraph.
+    
+    Parameters:
+        style_id (str): Value of the paragraph's w:pStyle element
+    
+    Returns:
+        tuple: (first number in the style ID or None,
+                'h2', 'quote' or 'code' from the style name keywords, or None)
+    """
+    digits = STYLE_ID_DIGITS.search(style_id)
+    style_number = int(digits.group()) if digits else None
+    
+    style_lower = style_id.lower()
+    # Check for common heading keywords in any language
+    if 'title' in style_lower or 'heading' in style_lower or 'nadpis' in style_lower:
+        block_type = 'h2'
+    # Check for quote styles
+    elif 'quote' in style_lower or 'citation' in style_lower:
+        block_type = 'quote'
+    # Check for code styles
+    elif 'code' in style_lower or 'source' in style_lower:
+        block_type = 'code'
+    else:
+        block_type = None
+    
+    return style_number, block_type
+
 def get_paragraph_outline_level(paragraph, namespaces):
     """Get the outline level of a paragraph (language-independent)."""
-    outline_lvl = paragraph.find('.//{%s}outlineLvl' % namespaces['w'])
+    outline_lvl = paragraph.find(OUTLINE_LVL_XPATH)
     if outline_lvl is not None:
         try:
-            level = int(outline_lvl.get('{%s}val' % namespaces['w'], '0'))
+            level = int(outline_lvl.get(VAL_ATTR, '0'))
             return level
         except (ValueError, TypeError):
             pass
     return None
 
-def check_heading_formatting(paragraph, namespaces):
-    """Check if paragraph has formatting typically used for headings."""
-    # Headings are often bold
-    is_bold = check_is_bold(paragraph, namespaces)
-    
-    # Headings often have larger font size
-    font_size = get_font_size(paragraph, namespaces)
-    has_large_font = font_size and font_size >= 14
-    
-    # Headings often have special spacing
-    spacing = paragraph.find('.//{%s}spacing' % namespaces['w'])
-    has_special_spacing = spacing is not None
-    
-    # Return True if the paragraph has at least some heading-like formatting
-    return is_bold or has_large_font or has_special_spacing
-
 def check_is_bold(paragraph, namespaces):
     """Check if paragraph is bold."""
-    # Check if all runs in the paragraph are bold
-    runs = paragraph.findall('.//{%s}r' % namespaces['w'])
-    if not runs:
-        return False
+    # If more than half the runs are bold, consider it a bold paragraph
+    runs = paragraph.findall(R_XPATH)
+    majority = len(runs) // 2 + 1
+    allowed_plain_runs = len(runs) - majority
     
+    # Stop counting as soon as the outcome is decided either way
     bold_runs = 0
+    plain_runs = 0
     for run in runs:
-        if run.find('.//{%s}b' % namespaces['w']) is not None:
+        if run.find(B_XPATH) is not None:
             bold_runs += 1
-    
-    # If more than half the runs are bold, consider it a bold paragraph
-    return bold_runs > len(runs) / 2
+            if bold_runs >= majority:
+                return True
+        else:
+            plain_runs += 1
+            if plain_runs > allowed_plain_runs:
+                return False
+    return False
 
 def get_font_size(paragraph, namespaces):
     """Get the font size of a paragraph (returns None if mixed or not specified)."""
     sizes = set()
-    runs = paragraph.findall('.//{%s}r' % namespaces['w'])
+    runs = paragraph.findall(R_XPATH)
     
     for run in runs:
-        sz = run.find('.//{%s}sz' % namespaces['w'])
+        sz = run.find(SZ_XPATH)
         if sz is not None:
             try:
                 # Font size in Word is in half-points (so 24 = 12pt)
-                size_half_points = int(sz.get('{%s}val' % namespaces['w'], '0'))
+                size_half_points = int(sz.get(VAL_ATTR, '0'))
                 sizes.add(size_half_points / 2)  # Convert to points
             except (ValueError, TypeError):
                 pass
@@ -1697,10 +1863,17 @@ def get_font_size(paragraph, namespaces):
         return next(iter(sizes))
     return None
 
-def process_docx_image(drawing, namespaces, image_rels, media_files):
-    """Process a DOCX image element with enhanced caption detection."""
+def process_docx_image(drawing, namespaces, image_rels, media_files, used_image_rel_ids=None):
+    """
+    Process a DOCX image element with enhanced caption detection.
+    
+    used_image_rel_ids collects the relationship IDs of the created image blocks. A drawing
+    without a relationship ID but with a text box caption takes the first unused one.
+    """
+    if used_image_rel_ids is None:
+        used_image_rel_ids = set()
     try:
-        log_message(f"DEBUG: Processing drawing with tag: {drawing.tag}", "basic")
+        log_message("DEBUG: Processing drawing with tag: %s", "basic", drawing.tag)
         
         # Initialize variables
         blip = None
@@ -1709,76 +1882,66 @@ def process_docx_image(drawing, namespaces, image_rels, media_files):
         textbox_caption = None
         
         # First try standard blip approach (this worked for image 1 before)
-        blip = drawing.find('.//{%s}blip' % namespaces['a'])
+        blip = drawing.find(BLIP_XPATH)
         if blip is not None:
             # Get relationship ID directly from blip
-            if '{%s}embed' % namespaces['r'] in blip.attrib:
-                rel_id = blip.get('{%s}embed' % namespaces['r'])
-                log_message(f"DEBUG: Found standard blip with embed ID: {rel_id}", "basic")
-            elif '{%s}link' % namespaces['r'] in blip.attrib:
-                rel_id = blip.get('{%s}link' % namespaces['r'])
-                log_message(f"DEBUG: Found standard blip with link ID: {rel_id}", "basic")
+            if EMBED_ATTR in blip.attrib:
+                rel_id = blip.get(EMBED_ATTR)
+                log_message("DEBUG: Found standard blip with embed ID: %s", "basic", rel_id)
+            elif LINK_ATTR in blip.attrib:
+                rel_id = blip.get(LINK_ATTR)
+                log_message("DEBUG: Found standard blip with link ID: %s", "basic", rel_id)
         
         # Get caption from docPr element (standard method)
-        doc_pr = drawing.find('.//{%s}docPr' % namespaces['wp'])
+        doc_pr = drawing.find(DOC_PR_XPATH)
         if doc_pr is not None and 'descr' in doc_pr.attrib:
             caption = doc_pr.get('descr')
-            log_message(f"DEBUG: Found caption in image description: {caption[:50] if caption else 'None'}...", "basic")
+            log_message("DEBUG: Found caption in image description: %s...", "basic", caption[:50] if caption else 'None')
             # Filter out AI-generated captions
             if caption and ('generated' in caption.lower() and ('ai' in caption.lower() or 'intelligence' in caption.lower())):
                 log_message("DEBUG: This appears to be AI-generated alt text, ignoring", "basic")
                 caption = None
         
-        # Look for textbox caption (for image 2)
-        txbx_elements = []
-        for elem in drawing.iter():
-            if elem.tag.endswith('txbx') or elem.tag.endswith('txbxContent'):
-                txbx_elements.append(elem)
-                
-        log_message(f"DEBUG: Found {len(txbx_elements)} potential textbox elements", "basic")
-        
-        for textbox in txbx_elements:
-            # Find paragraphs within the textbox
-            paras = []
-            for child in textbox.iter():
-                if child.tag.endswith('}p'):
-                    paras.append(child)
+        # Look for textbox caption (for image 2). Textbox paragraphs always sit in a w:txbxContent,
+        # so each textbox is walked once instead of re-walking the drawing for every candidate.
+        textbox_count = 0
+        for textbox in drawing.iter(TXBX_CONTENT_TAG):
+            textbox_count += 1
             
-            log_message(f"DEBUG: Found {len(paras)} paragraphs in textbox", "basic")
-            
-            for para in paras:
+            for para in textbox.iter(P_TAG):
                 # Check if it's a caption style
-                style = para.find('.//{%s}pStyle' % namespaces['w'])
+                style = para.find(P_STYLE_XPATH)
                 is_caption_style = False
                 if style is not None:
-                    style_val = style.get('{%s}val' % namespaces['w'], '')
-                    log_message(f"DEBUG: Paragraph in textbox has style: {style_val}", "basic")
+                    style_val = style.get(VAL_ATTR, '')
+                    log_message("DEBUG: Paragraph in textbox has style: %s", "basic", style_val)
                     if 'caption' in style_val.lower() or 'titulek' in style_val.lower():
                         is_caption_style = True
                 
                 # Extract the text
-                text_elements = para.findall('.//{%s}t' % namespaces['w'])
-                text_content = "".join([t.text or "" for t in text_elements])
+                text_content = get_text_content(para)
                 if text_content:
-                    log_message(f"DEBUG: Textbox paragraph content: {text_content[:50]}...", "basic")
+                    log_message("DEBUG: Textbox paragraph content: %s...", "basic", text_content[:50])
                     
                     # If it has caption style or starts with Figure/Image
                     if is_caption_style or text_content.strip().lower().startswith(('figure', 'image', 'obr')):
                         textbox_caption = text_content
-                        log_message(f"DEBUG: Found caption in textbox: {text_content[:50]}...", "basic")
+                        log_message("DEBUG: Found caption in textbox: %s...", "basic", text_content[:50])
                         break
             
             # Break out if we found a caption
             if textbox_caption:
                 break
         
+        log_message("DEBUG: Checked %s textbox elements", "basic", textbox_count)
+        
         # For image 2 (with textbox caption but missing blip)
         # If we have a textbox caption but no relationship ID yet, search more aggressively
         if textbox_caption and not rel_id:
             log_message("DEBUG: Found textbox caption but no relationship ID yet, searching in alternate content", "basic")
             
             # Try to find the relationship ID in the alternate content
-            alt_content = drawing.find('.//mc:AlternateContent', namespaces)
+            alt_content = drawing.find(ALT_CONTENT_XPATH)
             if alt_content is not None:
                 log_message("DEBUG: Found mc:AlternateContent element", "basic")
                 
@@ -1788,7 +1951,7 @@ def process_docx_image(drawing, namespaces, image_rels, media_files):
                         if attr_name.endswith('}id') or attr_name.endswith('}embed'):
                             if attr_val in image_rels:
                                 rel_id = attr_val
-                                log_message(f"DEBUG: Found relationship ID {rel_id} in alternate content", "basic")
+                                log_message("DEBUG: Found relationship ID %s in alternate content", "basic", rel_id)
                                 break
                     if rel_id:
                         break
@@ -1796,56 +1959,45 @@ def process_docx_image(drawing, namespaces, image_rels, media_files):
             # If still no relationship ID found, search in the entire drawing
             if not rel_id:
                 log_message("DEBUG: Searching entire drawing XML for relationship IDs", "basic")
-                drawing_xml = ET.tostring(drawing, encoding='unicode')
+                # Collect attribute values once instead of serializing the drawing and scanning it per ID
+                attribute_values = {attr_val for elem in drawing.iter() for attr_val in elem.attrib.values()}
                 
-                # Check for any relationship IDs in the drawing text
-                for potential_id in image_rels.keys():
-                    id_pattern = f'"{potential_id}"'  # Look for "rId11" pattern
-                    if id_pattern in drawing_xml:
+                # Check for any relationship IDs in the drawing attributes
+                for potential_id in image_rels:
+                    if potential_id in attribute_values:
                         rel_id = potential_id
-                        log_message(f"DEBUG: Found relationship ID {rel_id} in XML text", "basic")
+                        log_message("DEBUG: Found relationship ID %s in XML text", "basic", rel_id)
                         break
         
         # If we have a valid relationship ID but no blip, we'll create our own
         if rel_id in image_rels and not blip:
-            log_message(f"DEBUG: Creating custom blip handler for relationship {rel_id}", "basic")
+            log_message("DEBUG: Creating custom blip handler for relationship %s", "basic", rel_id)
             # We'll handle this later in the code
         
         # If we still don't have a relationship ID but have a textbox caption,
         # try to match with any unused image relationship
         if not rel_id and textbox_caption:
-            # Find all image relationships that have been used so far
-            used_ids = []
-            for block in blocks if 'blocks' in locals() else []:
-                if block.get('type') == 'image' and 'original_path' in block:
-                    for rel_id, path in image_rels.items():
-                        if path in block['original_path']:
-                            used_ids.append(rel_id)
-            
-            # Find any unused image relationship
-            for potential_id in image_rels:
-                if potential_id not in used_ids:
-                    rel_id = potential_id
-                    log_message(f"DEBUG: Using unused image relationship ID {rel_id}", "basic")
-                    break
-        
-        # If we still don't have a relationship ID, we can't process this image
-        if not rel_id or rel_id not in image_rels:
-            log_message(f"DEBUG: No valid relationship ID found. Available IDs: {list(image_rels.keys())}", "basic", is_warning=True)
+            # Find the first image relationship not used by an earlier image block
+            rel_id = next((potential_id for potential_id in image_rels if potential_id not in used_image_rel_ids), None)
+            if rel_id:
+                log_message("DEBUG: Using unused image relationship ID %s", "basic", rel_id)
+        
+        # Get the image path from the relationship - without a valid relationship ID we can't process this image
+        image_path = image_rels.get(rel_id) if rel_id else None
+        if image_path is None:
+            log_message("DEBUG: No valid relationship ID found. Available IDs: %s", "basic", list(image_rels.keys()), is_warning=True)
             return None
         
-        # Get the image path from the relationship
-        image_path = image_rels[rel_id]
-        log_message(f"DEBUG: Found image path from relationship ID {rel_id}: {image_path}", "basic")
+        log_message("DEBUG: Found image path from relationship ID %s: %s", "basic", rel_id, image_path)
         
         if not image_path.startswith('media/'):
-            log_message(f"DEBUG: Image path does not start with 'media/': {image_path}", "basic", is_warning=True)
+            log_message("DEBUG: Image path does not start with 'media/': %s", "basic", image_path, is_warning=True)
             return None
         
         # Get the actual file path
         file_path = media_files.get(image_path)
         if not file_path or not os.path.exists(file_path):
-            log_message(f"DEBUG: Image file not found: {file_path}", "basic", is_warning=True)
+            log_message("DEBUG: Image file not found: %s", "basic", file_path, is_warning=True)
             return None
         
         # Use the original image name
@@ -1853,26 +2005,26 @@ def process_docx_image(drawing, namespaces, image_rels, media_files):
         temp_img_path = os.path.join(tempfile.gettempdir(), original_filename)
         
         try:
-            shutil.copy2(file_path, temp_img_path)
-            log_message(f"DEBUG: Copied image to temporary location: {original_filename}", "basic")
+            # A hard link avoids copying the image data. It keeps the image available after
+            # the extraction folder is removed. Copy when linking is not possible.
+            if os.path.lexists(temp_img_path):
+                os.remove(temp_img_path)
+            try:
+                os.link(file_path, temp_img_path)
+            except OSError:
+                shutil.copy2(file_path, temp_img_path)
+            log_message("DEBUG: Copied image to temporary location: %s", "basic", original_filename)
         except Exception as copy_err:
-            log_message(f"DEBUG: Error copying image: {str(copy_err)}", "basic", is_warning=True)
+            log_message("DEBUG: Error copying image: %s", "basic", copy_err, is_warning=True)
             return None
         
-        # Determine display properties
-        display, float_alignment = determine_image_display(temp_img_path, drawing, namespaces)
-
+        # Original dimensions were read by the media extraction thread
+        dimensions = media_files.get_dimensions(image_path)
+        if dimensions:
+            log_message("DEBUG: Image dimensions: %sx%s", "basic", dimensions[0], dimensions[1])
         
-        # Get original dimensions
-        dimensions = None
-        try:
-            from PIL import Image as PILImage
-            with PILImage.open(temp_img_path) as img:
-                width, height = img.size
-                dimensions = (width, height)
-                log_message(f"DEBUG: Image dimensions: {width}x{height}", "basic")
-        except Exception as img_err:
-            log_message(f"DEBUG: Error getting image dimensions: {str(img_err)}", "basic", is_warning=True)
+        # Determine display properties - reuses the dimensions instead of opening the image again
+        display, float_alignment = determine_image_display(temp_img_path, drawing, namespaces, dimensions)
         
         # Create image block with dimensions
         image_block = create_image_block(temp_img_path, caption=textbox_caption or caption, display=display, float_alignment=float_alignment)
@@ -1881,25 +2033,26 @@ def process_docx_image(drawing, namespaces, image_rels, media_files):
         
         # Add the original path for reference
         image_block['original_path'] = image_path
+        used_image_rel_ids.add(rel_id)
         
         # Use textbox caption if available, otherwise use description caption
         if textbox_caption:
             image_block['caption'] = textbox_caption
-            log_message(f"DEBUG: Added textbox caption to image block: {textbox_caption[:50]}...", "basic")
+            log_message("DEBUG: Added textbox caption to image block: %s...", "basic", textbox_caption[:50])
         elif caption:
             image_block['caption'] = caption
-            log_message(f"DEBUG: Added description caption to image block: {caption[:50]}...", "basic")
+            log_message("DEBUG: Added description caption to image block: %s...", "basic", caption[:50])
         
-        log_message(f"DEBUG: Created image block from: {original_filename} with display: {display}", "basic")
+        log_message("DEBUG: Created image block from: %s with display: %s", "basic", original_filename, display)
         return image_block
         
     except Exception as e:
-        log_message(f"DEBUG: Error processing image: {str(e)}", "basic", is_warning=True)
+        log_message("DEBUG: Error processing image: %s", "basic", e, is_warning=True)
         import traceback
         log_message(traceback.format_exc(), "basic", is_warning=True)
         return None
 
-def determine_image_display(image_path=None, drawing=None, namespaces=None):
+def determine_image_display(image_path=None, drawing=None, namespaces=None, dimensions=None):
     """
     Determine the optimal display setting for an image based on its dimensions and context.
     
@@ -1907,6 +2060,7 @@ def determine_image_display(image_path=None, drawing=None, namespaces=None):
         image_path (str, optional): Path to the image file to analyze
         drawing (Element, optional): Drawing element from DOCX XML
         namespaces (dict, optional): XML namespaces for DOCX
+        dimensions (tuple, optional): Known (width, height) of the image, skips opening image_path
         
     Returns:
         tuple: (display_type, float_alignment) - float_alignment will be "start" or "end" if applicable
@@ -1920,28 +2074,28 @@ def determine_image_display(image_path=None, drawing=None, namespaces=None):
         is_wrapped = False
         
         if drawing is not None and namespaces is not None:
-            # Check for wrapSquare, wrapTight, or similar elements indicating wrapping
-            wrap_elems = []
-            for wrap_type in ['wrapSquare', 'wrapTight', 'wrapThrough', 'wrapTopBottom']:
-                wrap_elem = drawing.find('.//{%s}%s' % (namespaces['wp'], wrap_type))
-                if wrap_elem is not None:
-                    wrap_elems.append(wrap_elem)
+            # Check for wrapSquare, wrapTight, or similar elements indicating wrapping -
+            # lxml matches all four tags in one walk, ElementTree needs a find per tag
+            if LXML_AVAILABLE:
+                wrap_elem = next(drawing.iter(*WRAP_TAGS), None)
+            else:
+                wrap_elem = next((elem for elem in map(drawing.find, WRAP_XPATHS) if elem is not None), None)
                     
-            if wrap_elems:
+            if wrap_elem is not None:
                 is_wrapped = True
-                log_message(f"DEBUG: Image has text wrapping: {[elem.tag.split('}')[-1] for elem in wrap_elems]}", "basic")
+                log_message("DEBUG: Image has text wrapping: %s", "basic", wrap_elem.tag.split('}')[-1])
                 
                 # Default to right alignment (StoryMap's "end")
                 float_alignment = "end"
                 
                 # Try to find explicit alignment information
-                pos_h = drawing.find('.//{%s}positionH' % namespaces['wp'])
+                pos_h = drawing.find(POSITION_H_XPATH)
                 if pos_h is not None:
                     # Check for alignment value
-                    align_elem = pos_h.find('.//{%s}align' % namespaces['wp'])
+                    align_elem = pos_h.find(ALIGN_XPATH)
                     if align_elem is not None and align_elem.text:
                         align_val = align_elem.text.lower()
-                        log_message(f"DEBUG: Found explicit alignment: {align_val}", "basic")
+                        log_message("DEBUG: Found explicit alignment: %s", "basic", align_val)
                         if align_val == "left":
                             float_alignment = "start"
                         elif align_val == "right":
@@ -1950,42 +2104,44 @@ def determine_image_display(image_path=None, drawing=None, namespaces=None):
                     # Check relativeFrom attribute
                     if 'relativeFrom' in pos_h.attrib:
                         rel_from = pos_h.get('relativeFrom')
-                        log_message(f"DEBUG: Position relative from: {rel_from}", "basic")
+                        log_message("DEBUG: Position relative from: %s", "basic", rel_from)
                         # Some relative positions imply left/right alignment
                         if rel_from in ['right', 'rightMargin']:
                             float_alignment = "end"
                         elif rel_from in ['left', 'leftMargin']:
                             float_alignment = "start"
                 
-                log_message(f"DEBUG: Determined float alignment: {float_alignment}", "basic")
+                log_message("DEBUG: Determined float alignment: %s", "basic", float_alignment)
         
         # Get dimensions from the image file
         width = height = 0
         aspect_ratio = 0
         
-        from PIL import Image as PILImage
-        if image_path and os.path.exists(image_path):
+        if dimensions is None and image_path and os.path.exists(image_path):
             with PILImage.open(image_path) as img:
-                width, height = img.size
-                if height > 0:
-                    aspect_ratio = width / height
-                log_message(f"DEBUG: Image dimensions: {width}x{height}, aspect ratio: {aspect_ratio:.2f}", "basic")
+                dimensions = img.size
+        
+        if dimensions is not None:
+            width, height = dimensions
+            if height > 0:
+                aspect_ratio = width / height
+            log_message("DEBUG: Image dimensions: %sx%s, aspect ratio: %.2f", "basic", width, height, aspect_ratio)
         
         # Apply the display rules
         if width > 1200 and aspect_ratio >= (16/9):
             display_type = "wide"
-            log_message(f"DEBUG: Setting display to 'wide' (width > 1200 and aspect ratio ≥ 16:9)", "basic")
+            log_message("DEBUG: Setting display to 'wide' (width > 1200 and aspect ratio ≥ 16:9)", "basic")
         elif width < 800 or is_wrapped:
             display_type = "float"
-            log_message(f"DEBUG: Setting display to 'float' with alignment '{float_alignment}'", "basic")
+            log_message("DEBUG: Setting display to 'float' with alignment '%s'", "basic", float_alignment)
         else:
             display_type = "standard"
-            log_message(f"DEBUG: Setting display to 'standard' (default case)", "basic")
+            log_message("DEBUG: Setting display to 'standard' (default case)", "basic")
             
         return display_type, float_alignment
         
     except Exception as e:
-        log_message(f"DEBUG: Error determining image display: {str(e)}", "basic", is_warning=True)
+        log_message("DEBUG: Error determining image display: %s", "basic", e, is_warning=True)
         return "standard", None  # Default to standard on error 
       
 def process_docx_table(element, namespaces, hyperlink_rels=None):
@@ -1997,42 +2153,46 @@ def process_docx_table(element, namespaces, hyperlink_rels=None):
     
     try:
         # Process each row
-        for row in element.findall('.//{%s}tr' % namespaces['w']):
+        for row in element.findall(TR_XPATH):
             cells = []
             
             # Process each cell
-            for cell in row.findall('.//{%s}tc' % namespaces['w']):
-                cell_content = ""
+            for cell in row.findall(TC_XPATH):
+                cell_paragraphs = []
                 
                 # Extract text from paragraphs in the cell with hyperlinks
-                for paragraph in cell.findall('.//{%s}p' % namespaces['w']):
+                for paragraph in cell.findall(P_XPATH):
                     # Use the full extraction function with hyperlink processing
                     para_text, _ = extract_formatted_text(paragraph, namespaces, hyperlink_rels)
                     
                     if para_text:
-                        if cell_content:
-                            cell_content += "\n"
-                        cell_content += para_text
+                        cell_paragraphs.append(para_text)
                 
-                cells.append(cell_content)
+                # One line per non-empty paragraph
+                cells.append("\n".join(cell_paragraphs))
             
             if cells:
                 rows.append(cells)
         
         if rows:
-            log_message(f"Created table with {len(rows)} rows and {len(rows[0])} columns", "full")
+            log_message("Created table with %s rows and %s columns", "full", len(rows), len(rows[0]))
             return create_table_block(rows)
         
         log_message("No rows found in table", "full", is_warning=True)
         return None
     except Exception as e:
-        log_message(f"Error processing table: {str(e)}", "basic", is_warning=True)
+        log_message("Error processing table: %s", "basic", e, is_warning=True)
         import traceback
         log_message(traceback.format_exc(), "full", is_warning=True)
         return None
 
-def extract_formatted_text(element, namespaces, hyperlink_rels=None):
-    """Extract text with rich formatting from a DOCX element."""
+def extract_formatted_text(element, namespaces, hyperlink_rels=None, escape_text=False):
+    """
+    Extract text with rich formatting from a DOCX element.
+    
+    With escape_text, '&', '<' and '>' in the document text are escaped so the text
+    can be placed inside list item and caption HTML.
+    """
     if hyperlink_rels is None:
         hyperlink_rels = {}
         
@@ -2040,127 +2200,170 @@ def extract_formatted_text(element, namespaces, hyperlink_rels=None):
     paragraph_alignment = None
     
     # Check paragraph alignment
-    jc_elem = element.find('.//{%s}jc' % namespaces['w'])
+    jc_elem = element.find(JC_XPATH)
     if jc_elem is not None:
-        alignment_val = jc_elem.get('{%s}val' % namespaces['w'])
+        alignment_val = jc_elem.get(VAL_ATTR)
         if alignment_val:
             paragraph_alignment = alignment_val  # center, right, left, justify
-            log_message(f"Found paragraph alignment: {alignment_val}", "full")
-    
-    # Handle hyperlinks differently - find them first at paragraph level
-    hyperlinks = element.findall('.//{%s}hyperlink' % namespaces['w'])
-    hyperlink_runs = {}
-    
-    # Map hyperlink relationship IDs to their runs
-    for hyperlink in hyperlinks:
-        rel_id = hyperlink.get('{%s}id' % namespaces['r'])
-        if rel_id and rel_id in hyperlink_rels:
-            # Get the actual URL from relationships
-            target_url = hyperlink_rels[rel_id]
-            
-            # Find all runs within this hyperlink
-            for run in hyperlink.findall('.//{%s}r' % namespaces['w']):
-                run_text = "".join([t.text or "" for t in run.findall('.//{%s}t' % namespaces['w'])])
-                hyperlink_runs[id(run)] = (target_url, run_text)
-                log_message(f"Found hyperlink: {run_text} -> {target_url}", "full")
+            log_message("Found paragraph alignment: %s", "full", alignment_val)
     
-    # Process each run
+    # Process each run - runs inside a w:hyperlink come with the link's target URL
     has_text = False
     run_count = 0
     
-    for run in element.findall('.//{%s}r' % namespaces['w']):
+    for run, target_url in iter_runs_with_hyperlinks(element, hyperlink_rels):
         run_count += 1
-        # Check for different formatting properties
-        formatting = {
-            'bold': run.find('.//{%s}b' % namespaces['w']) is not None,
-            'italic': run.find('.//{%s}i' % namespaces['w']) is not None,
-            'underline': run.find('.//{%s}u' % namespaces['w']) is not None,
-            'strike': run.find('.//{%s}strike' % namespaces['w']) is not None,
-        }
+        # Collect formatting properties and text in a single walk over the run
+        formatting = {'bold': False, 'italic': False, 'underline': False, 'strike': False, 'sub': False, 'sup': False}
+        vert_align = None
+        color_elem = None
+        text_fragments = []
+        has_line_break = False
+        
+        for child in (run.iter(*RUN_WALK_TAGS) if LXML_AVAILABLE else run.iter()):
+            child_tag = child.tag
+            if child_tag == T_TAG:
+                if child.text is not None:
+                    text_fragments.append(child.text)
+                    has_text = True
+            elif child_tag in RUN_FORMATTING_TAGS:
+                formatting[RUN_FORMATTING_TAGS[child_tag]] = True
+            elif child_tag == VERT_ALIGN_TAG:
+                if vert_align is None:
+                    vert_align = child
+            elif child_tag == COLOR_TAG:
+                if color_elem is None:
+                    color_elem = child
+            elif child_tag == BR_TAG:
+                has_line_break = True
         
         # Check for vertical alignment (subscript/superscript)
-        vert_align = run.find('.//{%s}vertAlign' % namespaces['w'])
         if vert_align is not None:
-            val = vert_align.get('{%s}val' % namespaces['w'])
+            val = vert_align.get(VAL_ATTR)
             if val == 'subscript':
                 formatting['sub'] = True
             elif val == 'superscript':
                 formatting['sup'] = True
         
         # Check for color
-        color_elem = run.find('.//{%s}color' % namespaces['w'])
         text_color = None
         if color_elem is not None:
-            color_val = color_elem.get('{%s}val' % namespaces['w'])
+            color_val = color_elem.get(VAL_ATTR)
             if color_val and color_val.lower() != 'auto':
                 text_color = color_val
-                log_message(f"Found text color: {text_color}", "full")
-        
-        # Get text
-        run_text = ""
-        text_elements = run.findall('.//{%s}t' % namespaces['w'])
-        for text_elem in text_elements:
-            if text_elem.text is not None:
-                run_text += text_elem.text
-                has_text = True
+                log_message("Found text color: %s", "full", text_color)
         
         # Check for line breaks and special characters
-        br_elem = run.find('.//{%s}br' % namespaces['w'])
-        if br_elem is not None:
-            run_text += "\n"
+        if has_line_break:
+            text_fragments.append("\n")
             log_message("Found line break", "full")
         
+        # Get text
+        run_text = "".join(text_fragments)
+        
+        if not run_text:
+            continue
+        
         # Apply formatting
-        if run_text:
-            formatted_text = run_text
-            
-            # Check if this run is part of a hyperlink
-            run_id = id(run)
-            if run_id in hyperlink_runs:
-                url, link_text = hyperlink_runs[run_id]
-                # Make sure URL is properly formed
-                if url and not url.startswith(('http://', 'https://', '#')):
-                    url = 'https://' + url
-                
-                formatted_text = f'<a href="{url}" rel="noopener noreferrer" target="_blank">{formatted_text}</a>'
-                log_message(f"Applied hyperlink formatting with URL: {url}", "full")
-            
-            # Apply formatting in specific order to handle nesting correctly
-            if formatting.get('sub', False):
-                formatted_text = f"<sub>{formatted_text}</sub>"
-            if formatting.get('sup', False):
-                formatted_text = f"<sup>{formatted_text}</sup>"
-            if formatting.get('italic'):
-                formatted_text = f"<em>{formatted_text}</em>"
-            if formatting.get('bold'):
-                formatted_text = f"<strong>{formatted_text}</strong>"
-            if formatting.get('underline'):
-                formatted_text = f"<u>{formatted_text}</u>"
-            if formatting.get('strike'):
-                formatted_text = f"<s>{formatted_text}</s>"
-            
-            # Apply color if present
-            if text_color:
-                formatted_text = f'<span class="sm-text-color-{text_color}">{formatted_text}</span>'
-            
-            text_parts.append(formatted_text)
+        run_text_html = run_text.translate(HTML_TEXT_ESCAPE) if escape_text else run_text
+        
+        # Plain runs need no wrapping tags
+        if target_url is None and text_color is None and not any(formatting.values()):
+            text_parts.append(run_text_html)
+            continue
+        
+        # Wrapping tags are collected from the innermost outwards and joined once,
+        # instead of rebuilding the string for every wrapper
+        open_tags = []
+        close_tags = []
+        
+        # Check if this run is part of a hyperlink
+        if target_url is not None:
+            log_message("Found hyperlink: %s -> %s", "full", run_text, target_url)
+            open_tags.append(get_hyperlink_open_tag(target_url))
+            close_tags.append('</a>')
+        
+        # Apply formatting in specific order to handle nesting correctly
+        for key, open_tag, close_tag in RUN_FORMATTING_WRAPPERS:
+            if formatting[key]:
+                open_tags.append(open_tag)
+                close_tags.append(close_tag)
+        
+        # Apply color if present
+        if text_color:
+            open_tags.append(f'<span class="sm-text-color-{text_color}">')
+            close_tags.append('</span>')
+        
+        open_tags.reverse()
+        text_parts.append("".join(open_tags))
+        text_parts.append(run_text_html)
+        text_parts.append("".join(close_tags))
     
     # Return a non-empty string even for empty paragraphs with alignment
     if not has_text and paragraph_alignment:
         log_message("Empty paragraph with alignment", "full")
         return " ", paragraph_alignment
     
-    log_message(f"Extracted text with {run_count} runs", "full")
+    log_message("Extracted text with %s runs", "full", run_count)
     return "".join(text_parts), paragraph_alignment
 
 
+@lru_cache(maxsize=None)
+def get_hyperlink_open_tag(url):
+    """
+    Build the opening <a> tag for a hyperlink target.
+    
+    Every run of a hyperlink (and every link to the same target) shares the tag,
+    so it is built once per URL.
+    
+    Parameters:
+        url (str): Target of the hyperlink relationship
+    
+    Returns:
+        str: Opening <a> tag
+    """
+    # Make sure URL is properly formed
+    if url and not url.startswith(('http://', 'https://', '#')):
+        url = 'https://' + url
+    return f'<a href="{url}" rel="noopener noreferrer" target="_blank">'
+
+
+def iter_runs_with_hyperlinks(parent, hyperlink_rels, target_url=None):
+    """
+    Yield the runs below an element in document order together with their hyperlink target.
+    
+    The hyperlink context is tracked while walking the tree, so each run is visited once
+    and no separate pass over the w:hyperlink elements is needed. Runs are not searched
+    for nested runs - their text (e.g. of a text box in a drawing) is read with the run.
+    
+    Parameters:
+        parent: Element to search, usually a paragraph
+        hyperlink_rels (dict): Hyperlink relationship IDs mapped to URLs
+        target_url (str, optional): URL of the enclosing hyperlink
+    
+    Yields:
+        tuple: (run element, URL of the enclosing hyperlink or None)
+    """
+    for child in parent:
+        child_tag = child.tag
+        if child_tag == R_TAG:
+            yield child, target_url
+        elif child_tag == HYPERLINK_TAG:
+            rel_id = child.get(ID_ATTR)
+            link_url = hyperlink_rels.get(rel_id) if rel_id else None
+            yield from iter_runs_with_hyperlinks(child, hyperlink_rels, target_url if link_url is None else link_url)
+        else:
+            # Runs can also sit in smart tags, content controls, tracked insertions, ...
+            yield from iter_runs_with_hyperlinks(child, hyperlink_rels, target_url)
+
+
 def create_storymap(gis, title, tags, summary, description, cover_image, content_blocks):
     """Create a StoryMap with placeholders."""
     try:
         # Unpack content_blocks if it's a tuple containing the blocks and temp_dir
         if isinstance(content_blocks, tuple) and len(content_blocks) == 2:
             content_blocks, temp_dir = content_blocks
-            log_message(f"Using temporary directory for content: {temp_dir}", "full")
+            log_message("Using temporary directory for content: %s", "full", temp_dir)
         
         # Create new StoryMap
         log_message("Creating new StoryMap instance", "basic")
@@ -2179,14 +2382,14 @@ def create_storymap(gis, title, tags, summary, description, cover_image, content
             add_description_block(story, description, placeholder_ids, parsed_blocks)
 
         # Add content blocks with placeholders
-        log_message(f"Adding {len(content_blocks)} content blocks to StoryMap", "basic")
+        log_message("Adding %s content blocks to StoryMap", "basic", len(content_blocks))
         blocks_added = 0
         
         for i, block in enumerate(content_blocks):
             block_type = block.get('type')
             placeholder_key = f"{block_type}_{i}"
             
-            log_message(f"Adding block {i+1}/{len(content_blocks)}: {block_type}", "full")
+            log_message("Adding block %s/%s: %s", "full", i+1, len(content_blocks), block_type)
             
             if block_type == 'separator':
                 add_separator_block(story, block, placeholder_key, placeholder_ids, parsed_blocks)
@@ -2200,7 +2403,7 @@ def create_storymap(gis, title, tags, summary, description, cover_image, content
                 # Skip empty text blocks
                 text_content = block.get('text', '')
                 if not text_content or text_content.strip() == "" or text_content == "...":
-                    log_message(f"Skipping empty text block of type '{block.get('text_type', 'paragraph')}'", "basic")
+                    log_message("Skipping empty text block of type '%s'", "basic", block.get('text_type', 'paragraph'))
                     continue
                 
                 add_text_block(story, block, i, placeholder_key, placeholder_ids, parsed_blocks)
@@ -2217,24 +2420,20 @@ def create_storymap(gis, title, tags, summary, description, cover_image, content
         # Save StoryMap
         log_message("Saving StoryMap...", "basic")
         storymap_item = story.save(title=title, tags=tags)
-        log_message(f"StoryMap saved, item ID: {storymap_item.id}", "basic")
+        log_message("StoryMap saved, item ID: %s", "basic", storymap_item.id)
         
         # Log statistics
-        log_message(f"Added {blocks_added} of {len(content_blocks)} content blocks to StoryMap", "basic")
-        blocks_by_type = {}
-        for node_id, block in parsed_blocks.items():
-            block_type = block.get('type')
-            if block_type in blocks_by_type:
-                blocks_by_type[block_type] += 1
-            else:
-                blocks_by_type[block_type] = 1
-                
-        log_message(f"Content blocks by type: {', '.join([f'{count} {type}(s)' for type, count in blocks_by_type.items()])}", "basic")
+        log_message("Added %s of %s content blocks to StoryMap", "basic", blocks_added, len(content_blocks))
+        # The per-type summary is only counted when it will be logged
+        if DEBUG_LEVEL_INT >= LEVEL_PRIORITY["basic"]:
+            blocks_by_type = Counter(block.get('type') for block in parsed_blocks.values())
+            log_message("Content blocks by type: %s", "basic",
+                        ', '.join([f'{count} {type}(s)' for type, count in blocks_by_type.items()]))
         
         return storymap_item, placeholder_ids, parsed_blocks, image_dimensions
         
     except Exception as e:
-        log_message(f"Error creating StoryMap: {str(e)}", "none", is_error=True)
+        log_message("Error creating StoryMap: %s", "none", e, is_error=True)
         import traceback
         log_message(traceback.format_exc(), "basic", is_error=True)
         raise
@@ -2242,7 +2441,7 @@ def create_storymap(gis, title, tags, summary, description, cover_image, content
 def process_cover_image(story, title, summary, cover_image, image_dimensions):
     """Process and add cover image to the StoryMap with improved error handling and format conversion."""
     if cover_image and os.path.exists(cover_image):
-        log_message(f"Processing cover image: {cover_image}", "basic")
+        log_message("Processing cover image: %s", "basic", cover_image)
         
         # Use a generic safe name for cover image
         _, extension = os.path.splitext(cover_image)
@@ -2253,45 +2452,46 @@ def process_cover_image(story, title, summary, cover_image, image_dimensions):
         try:
             # Try to open and resave the image using PIL to resolve potential format issues
             try:
-                from PIL import Image as PILImage
                 with PILImage.open(cover_image) as img:
                     # Log image format details for debugging
-                    log_message(f"Cover image format: {img.format}, mode: {img.mode}, size: {img.size}", "basic")
-                    
-                    # Create a new RGB image if needed
-                    if img.mode != 'RGB':
-                        log_message(f"Converting image from {img.mode} to RGB mode", "basic")
-                        img = img.convert('RGB')
+                    log_message("Cover image format: %s, mode: %s, size: %s", "basic", img.format, img.mode, img.size)
                     
-                    # Save to a temp location with a more standard format
-                    reprocessed_path = os.path.join(tempfile.gettempdir(), f"reprocessed_{safe_cover_filename}")
-                    img.save(reprocessed_path, format='JPEG', quality=95)
-                    log_message(f"Image reprocessed and saved to {reprocessed_path}", "basic")
-                    
-                    # Use the reprocessed image instead
-                    temp_cover_path = reprocessed_path
+                    if img.format == 'JPEG' and img.mode == 'RGB':
+                        # Already a standard RGB JPEG - copy it instead of decoding and encoding it again
+                        shutil.copy2(cover_image, temp_cover_path)
+                        log_message("Cover image is an RGB JPEG, copied as-is", "basic")
+                    else:
+                        # Create a new RGB image if needed
+                        if img.mode != 'RGB':
+                            log_message("Converting image from %s to RGB mode", "basic", img.mode)
+                            img = img.convert('RGB')
+                        
+                        # Save to a temp location with a more standard format
+                        reprocessed_path = os.path.join(tempfile.gettempdir(), f"reprocessed_{safe_cover_filename}")
+                        img.save(reprocessed_path, format='JPEG', quality=95)
+                        log_message("Image reprocessed and saved to %s", "basic", reprocessed_path)
+                        
+                        # Use the reprocessed image instead
+                        temp_cover_path = reprocessed_path
                     
-                    # Get dimensions from the reprocessed image
+                    # Get dimensions from the image
                     dimensions = img.size
                     if dimensions:
                         width, height = dimensions
                         image_dimensions['cover_image'] = (width, height)
-                        log_message(f"Cover image dimensions: {width}x{height}", "basic")
-            except ImportError:
-                log_message("PIL/Pillow not available - copying image as-is", "basic", is_warning=True)
-                shutil.copy2(cover_image, temp_cover_path)
+                        log_message("Cover image dimensions: %sx%s", "basic", width, height)
             except Exception as pil_err:
-                log_message(f"Error reprocessing image with PIL: {str(pil_err)}", "basic", is_warning=True)
+                log_message("Error reprocessing image with PIL: %s", "basic", str(pil_err), is_warning=True)
                 # Fall back to direct copy
                 shutil.copy2(cover_image, temp_cover_path)
-                log_message(f"Copied cover image to: {safe_cover_filename}", "full")
+                log_message("Copied cover image to: %s", "full", safe_cover_filename)
                 
                 # Get dimensions without resizing
                 dimensions = extract_image_dimensions(temp_cover_path)
                 if dimensions:
                     width, height = dimensions
                     image_dimensions['cover_image'] = (width, height)
-                    log_message(f"Cover image dimensions: {width}x{height}", "basic")
+                    log_message("Cover image dimensions: %sx%s", "basic", width, height)
             
             # Create StoryImage object for the cover
             try:
@@ -2300,12 +2500,12 @@ def process_cover_image(story, title, summary, cover_image, image_dimensions):
                 story.cover(title=title, summary=summary, image=cover_img)
                 log_message("Successfully set cover with image", "basic")
             except Exception as e:
-                log_message(f"Error setting cover with image: {str(e)}", "basic", is_warning=True)
+                log_message("Error setting cover with image: %s", "basic", e, is_warning=True)
                 # Fall back to cover without image
                 story.cover(title=title, summary=summary)
                 log_message("Falling back to cover without image", "basic")
         except Exception as e:
-            log_message(f"Error processing cover image: {str(e)}", "basic", is_warning=True)
+            log_message("Error processing cover image: %s", "basic", e, is_warning=True)
             log_message("Setting cover without image", "basic")
             story.cover(title=title, summary=summary)
     else:
@@ -2313,6 +2513,27 @@ def process_cover_image(story, title, summary, cover_image, image_dimensions):
         story.cover(title=title, summary=summary)
         
         
+@lru_cache(maxsize=4096)
+def read_image_size(image_path, mtime_ns, file_size):
+    """
+    Read the size of an image, cached per file version.
+    
+    mtime_ns and file_size are only part of the cache key, so an image file that is
+    replaced under the same temp path (e.g. by a later run) is read again.
+    
+    Args:
+        image_path (str): Path to the image file
+        mtime_ns (int): Modification time of the file in nanoseconds
+        file_size (int): Size of the file in bytes
+        
+    Returns:
+        tuple: (width, height)
+    """
+    # PIL only reads the header to get the size, the pixel data is not decoded
+    with PILImage.open(image_path) as img:
+        return img.size
+
+
 def extract_image_dimensions(image_path):
     """
     Extract dimensions from an image without resizing it.
@@ -2324,19 +2545,14 @@ def extract_image_dimensions(image_path):
         tuple: (width, height) or None if dimensions couldn't be extracted
     """
     try:
-        from PIL import Image as PILImage
-        
-        # Open the image and get its dimensions
-        with PILImage.open(image_path) as img:
-            dimensions = img.size
-            log_message(f"Image dimensions: {dimensions[0]}x{dimensions[1]}", "full")
-            return dimensions
+        # Repeated images are served from the cache - the file stat in the key makes replaced files read again
+        file_stat = os.stat(image_path)
+        dimensions = read_image_size(image_path, file_stat.st_mtime_ns, file_stat.st_size)
+        log_message("Image dimensions: %sx%s", "full", dimensions[0], dimensions[1])
+        return dimensions
             
-    except ImportError:
-        log_message("PIL (Pillow) library not found. Image dimension extraction skipped.", "basic", is_warning=True)
-        return None
     except Exception as e:
-        log_message(f"Error extracting image dimensions: {str(e)}. Using original image.", "basic", is_warning=True)
+        log_message("Error extracting image dimensions: %s. Using original image.", "basic", e, is_warning=True)
         return None
         
         
@@ -2347,7 +2563,7 @@ def add_description_block(story, description, placeholder_ids, parsed_blocks):
     node_id = story.add(text)
     placeholder_ids["description"] = node_id
     parsed_blocks[node_id] = {"type": "text", "text_type": "paragraph", "text": description}
-    log_message(f"Added description text, node ID: {node_id}", "full")
+    log_message("Added description text, node ID: %s", "full", node_id)
 
 
 def add_separator_block(story, block, placeholder_key, placeholder_ids, parsed_blocks):
@@ -2355,16 +2571,16 @@ def add_separator_block(story, block, placeholder_key, placeholder_ids, parsed_b
     node_id = story.add()
     placeholder_ids[placeholder_key] = node_id
     parsed_blocks[node_id] = block
-    log_message(f"Added separator, node ID: {node_id}", "full")
+    log_message("Added separator, node ID: %s", "full", node_id)
 
 def add_image_block(story, block, placeholder_key, placeholder_ids, parsed_blocks, image_dimensions):
     """Add an image block to the StoryMap with proper float alignment."""
     # Get image path
     image_path = block.get('path')
-    log_message(f"Processing image: {image_path}", "full")
+    log_message("Processing image: %s", "full", image_path)
     
-    # Get dimensions without resizing
-    dimensions = extract_image_dimensions(image_path)
+    # Get dimensions without resizing - DOCX images already carry the size read at extraction
+    dimensions = block.get('dimensions') or extract_image_dimensions(image_path)
     if dimensions:
         width, height = dimensions
         image_dimensions[image_path] = (width, height)
@@ -2393,12 +2609,12 @@ def add_image_block(story, block, placeholder_key, placeholder_ids, parsed_block
     # Store float alignment for JSON update later
     if display == 'float' and float_alignment:
         parsed_blocks[node_id]['float_alignment'] = float_alignment
-        log_message(f"Stored float alignment '{float_alignment}' for later JSON update", "full")
+        log_message("Stored float alignment '%s' for later JSON update", "full", float_alignment)
     
     if dimensions:
         parsed_blocks[node_id]['dimensions'] = dimensions
     
-    log_message(f"Added image with display '{display}', node ID: {node_id}", "full")
+    log_message("Added image with display '%s', node ID: %s", "full", display, node_id)
     return node_id
     
 
@@ -2410,30 +2626,15 @@ def add_text_block(story, block, i, placeholder_key, placeholder_ids, parsed_blo
     
     # Skip empty text blocks
     if not text_content or text_content.strip() == "" or text_content == "...":
-        log_message(f"Skipping empty text block of type '{text_type}'", "basic")
+        log_message("Skipping empty text block of type '%s'", "basic", text_type)
         return None  # Return None for skipped blocks
     
     placeholder_text = f"PLACEHOLDER_TEXT_{i}"
     
     # Convert text_type to valid TextStyles enum value
-    if text_type == 'bullet-list':
-        text_style = TextStyles.BULLETLIST
-    elif text_type == 'numbered-list':
-        text_style = TextStyles.NUMBERLIST
-    elif text_type == 'h2':
-        text_style = TextStyles.HEADING
-    elif text_type == 'h3':
-        text_style = TextStyles.HEADING2
-    elif text_type == 'h4':
-        text_style = TextStyles.HEADING3
-    elif text_type == 'quote':
-        text_style = TextStyles.QUOTE
-    elif text_type == 'large-paragraph':
-        text_style = TextStyles.LARGEPARAGRAPH
-    else:
-        text_style = TextStyles.PARAGRAPH
+    text_style = TEXT_STYLES.get(text_type, TextStyles.PARAGRAPH)
     
-    log_message(f"Adding text of type '{text_type}' with placeholder", "full")
+    log_message("Adding text of type '%s' with placeholder", "full", text_type)
     text = Text(placeholder_text, text_style)
     node_id = story.add(text)
     
@@ -2445,22 +2646,24 @@ def add_text_block(story, block, i, placeholder_key, placeholder_ids, parsed_blo
         "text": text_content,
         "alignment": block.get('alignment', None)
     }
-    log_message(f"Added text placeholder, node ID: {node_id}", "full")
+    log_message("Added text placeholder, node ID: %s", "full", node_id)
     return node_id
 
 def add_table_block(story, block, placeholder_key, placeholder_ids, parsed_blocks):
     """Add a table block to the StoryMap."""
     rows = block.get('rows', [])
     num_rows = len(rows)
-    num_cols = max(len(row) for row in rows) if rows else 2
+    # Keep the column count for update_table_node, an empty table is created with 2 columns
+    block['num_cols'] = max((len(row) for row in rows), default=0)
+    num_cols = block['num_cols'] or 2
     caption = block.get('caption', '')
     
-    log_message(f"Adding table with {num_rows} rows, {num_cols} columns, caption: {caption[:30] if caption else 'None'}", "full")
+    log_message("Adding table with %s rows, %s columns, caption: %s", "full", num_rows, num_cols, caption[:30] if caption else 'None')
     table = Table(num_rows, num_cols)
     node_id = story.add(table, caption)  # Pass caption here
     placeholder_ids[placeholder_key] = node_id
     parsed_blocks[node_id] = block
-    log_message(f"Added table, node ID: {node_id}", "full")
+    log_message("Added table, node ID: %s", "full", node_id)
 
 
 def add_code_block(story, block, i, placeholder_key, placeholder_ids, parsed_blocks):
@@ -2472,8 +2675,8 @@ def add_code_block(story, block, i, placeholder_key, placeholder_ids, parsed_blo
     placeholder_text = f"PLACEHOLDER_CODE_{i}"
     
     # Log what we're doing
-    log_message(f"Adding code block with language {language} and placeholder", "full")
-    log_message(f"Code content: {code_content[:50]}...", "full")
+    log_message("Adding code block with language %s and placeholder", "full", language)
+    log_message("Code content: %s...", "full", code_content[:50])
     
     # Initially add as a text node with a placeholder
     text = Text(placeholder_text, TextStyles.PARAGRAPH)
@@ -2486,7 +2689,7 @@ def add_code_block(story, block, i, placeholder_key, placeholder_ids, parsed_blo
         "code": code_content,
         "language": language
     }
-    log_message(f"Added code placeholder, node ID: {node_id}, to be transformed later", "full")
+    log_message("Added code placeholder, node ID: %s, to be transformed later", "full", node_id)
     return node_id
 
 def update_storymap_json(storymap_item, placeholder_ids, parsed_blocks, image_dimensions=None):
@@ -2499,18 +2702,18 @@ def update_storymap_json(storymap_item, placeholder_ids, parsed_blocks, image_di
             
         # Update content in the data
         replacements = update_storymap_content(main_data, parsed_blocks)
-        log_message(f"Made {replacements} content replacements in data", "basic")
+        log_message("Made %s content replacements in data", "basic", replacements)
         
         # Update image dimensions in resources
         if 'resources' in main_data and image_dimensions:
             images_updated = update_image_dimensions(main_data, parsed_blocks, image_dimensions)
-            log_message(f"Updated dimensions for {images_updated} images in resources section", "basic")
+            log_message("Updated dimensions for %s images in resources section", "basic", images_updated)
         
         # Save updated data back to the StoryMap
         return save_storymap_updates(storymap_item, main_data)
         
     except Exception as e:
-        log_message(f"Error updating StoryMap JSON: {str(e)}", "none", is_error=True)
+        log_message("Error updating StoryMap JSON: %s", "none", e, is_error=True)
         import traceback
         log_message(traceback.format_exc(), "basic", is_error=True)
         return False
@@ -2528,12 +2731,12 @@ def get_storymap_data(storymap_item):
         if isinstance(resource, dict) and 'resource' in resource:
             if resource['resource'].startswith('draft_'):
                 draft_file_name = resource['resource']
-                log_message(f"Found draft file: {draft_file_name}", "full")
+                log_message("Found draft file: %s", "full", draft_file_name)
                 break
     
     main_data = None
     if draft_file_name:
-        log_message(f"Retrieving draft file content", "basic")
+        log_message("Retrieving draft file content", "basic")
         draft_content = storymap_item.resources.get(draft_file_name)
         
         if isinstance(draft_content, dict):
@@ -2541,7 +2744,11 @@ def get_storymap_data(storymap_item):
             log_message("Draft content is already a dictionary", "full")
         else:
             try:
-                main_data = json.loads(draft_content)
+                # orjson parses str and bytes, anything it rejects is retried with json
+                try:
+                    main_data = orjson.loads(draft_content) if orjson is not None else json.loads(draft_content)
+                except ValueError:
+                    main_data = json.loads(draft_content)
                 log_message("Parsed draft content as JSON", "full")
             except:
                 log_message("Failed to parse draft content. Will try main data.", "basic", is_warning=True)
@@ -2555,180 +2762,172 @@ def get_storymap_data(storymap_item):
         log_message("Unable to get valid StoryMap data structure. Cannot proceed.", "none", is_error=True)
         return None
         
-    log_message(f"Retrieved StoryMap data with {len(main_data['nodes'])} nodes", "basic")
+    log_message("Retrieved StoryMap data with %s nodes", "basic", len(main_data['nodes']))
     return main_data
     
 
+def transform_code_node(node_id, node, block, main_data):
+    """Turn the text placeholder node of a code block into a code node. Returns the number of replacements."""
+    if node.get('type') != 'text':
+        return 0
+    try:
+        log_message("Transforming text node %s to code node", "full", node_id)
+        
+        # Get the code content and language
+        code_content = block.get('code', '')
+        language = block.get('language', 'text').lower()
+        mapped_language = LANGUAGE_MAPPING.get(language, 'txt')
+        
+        # Update the node type and data structure
+        node['type'] = 'code'
+        
+        # Create proper code node data structure
+        node['data'] = {
+            'content': code_content,
+            'lang': mapped_language,
+            'lineNumbers': True
+        }
+        
+        log_message("Successfully transformed node %s to code node with language %s", "full", node_id, mapped_language)
+        return 1
+    except Exception as e:
+        log_message("Failed to transform text to code node %s: %s", "basic", node_id, e, is_warning=True)
+        return 0
+
+
+def update_text_node(node_id, node, block, main_data):
+    """Replace the placeholder text of a text node. Returns the number of replacements."""
+    if node.get('type') != 'text' or 'data' not in node or 'text' not in node['data']:
+        return 0
+    # The description node is also in parsed_blocks but holds real text, leave it alone
+    current_text = node['data']['text']
+    if not current_text.startswith("PLACEHOLDER_TEXT_"):
+        return 0
+    
+    # Get the text content
+    text_content = block.get('text', '')
+    
+    # Skip completely empty text nodes
+    if not text_content or text_content.strip() == "" or text_content == "...":
+        log_message("Skipping empty text block for node %s", "basic", node_id)
+        # Remove this node from the nodes collection
+        main_data['nodes'].pop(node_id, None)
+        log_message("Removed empty text node %s", "basic", node_id)
+        return 0
+    
+    # Debug information
+    log_message("For node %s, replacing placeholder with text: '%s...'", "full", node_id, text_content[:30])
+    
+    # Ensure we have non-empty text to replace with
+    if not text_content or text_content.strip() == "":
+        # If the parsed text is empty, create a non-empty placeholder
+        text_content = " "  # Single space
+        log_message("Empty text content for node %s, using space placeholder", "basic", node_id, is_warning=True)
+    
+    # Update the text content
+    node['data']['text'] = text_content
+    
+    # Update alignment if present
+    alignment = block.get('alignment')
+    if alignment in TEXT_ALIGNMENTS:
+        node['data']['textAlignment'] = TEXT_ALIGNMENTS[alignment]
+        log_message("Set text alignment to %s", "full", TEXT_ALIGNMENTS[alignment])
+    
+    log_message("Replaced placeholder in node %s", "full", node_id)
+    return 1
+
+
+def update_table_node(node_id, node, block, main_data):
+    """Fill a table node with the rows and caption of a table block. Returns the number of replacements."""
+    if node.get('type') != 'table' or 'data' not in node:
+        return 0
+    
+    # Update table data with rows content
+    rows = block.get('rows', [])
+    num_rows = len(rows)
+    # Counted by add_table_block
+    num_cols = block['num_cols'] if 'num_cols' in block else max((len(row) for row in rows), default=0)
+    
+    log_message("Updating table node %s with %sx%s cells", "full", node_id, num_rows, num_cols)
+    
+    # Update table data
+    node['data']['numRows'] = num_rows
+    node['data']['numColumns'] = num_cols
+    
+    # Create cells structure
+    cells = node['data'].setdefault('cells', {})
+    
+    # Populate cells - the column keys are built once, zip stops at the defined columns
+    col_keys = [str(col_idx) for col_idx in range(num_cols)]
+    for row_idx, row in enumerate(rows):
+        cells.setdefault(str(row_idx), {}).update(
+            {col_key: {"value": cell_value} for col_key, cell_value in zip(col_keys, row)}
+        )
+    
+    # Add caption if present
+    if 'caption' in block and block['caption']:
+        node['data']['caption'] = block['caption']
+        log_message("Added caption to table: %s...", "full", block['caption'][:30])
+    
+    log_message("Updated table in node %s", "full", node_id)
+    return 1
+
+
+def update_image_node(node_id, node, block, main_data):
+    """Apply the caption and float alignment of an image block. Returns the number of replacements."""
+    if node.get('type') != 'image' or 'data' not in node:
+        return 0
+    replacements = 0
+    
+    # Check if there's a caption
+    if 'caption' in block and block['caption']:
+        node['data']['caption'] = block['caption']
+        log_message("Added caption to image: %s...", "full", block['caption'][:30])
+        replacements += 1
+    
+    # Apply float alignment if specified
+    if block.get('display') == 'float' and block.get('float_alignment'):
+        if 'config' not in node:
+            node['config'] = {}
+        node['config']['size'] = 'float'
+        node['config']['floatAlignment'] = block['float_alignment']
+        log_message("Applied float alignment '%s' to image node %s", "full", block['float_alignment'], node_id)
+        replacements += 1
+    
+    return replacements
+
+
+# Node updaters by parsed block type, blocks of other types leave their node unchanged
+NODE_UPDATERS = {
+    'code': transform_code_node,
+    'text': update_text_node,
+    'table': update_table_node,
+    'image': update_image_node
+}
+
+
 def update_storymap_content(main_data, parsed_blocks):
-    """Update the StoryMap content with the actual content from parsed blocks."""
-    # Language mapping for code blocks
-    language_mapping = {
-        'text': 'txt',
-        'python': 'py',
-        'javascript': 'js',
-        'typescript': 'ts',
-        'java': 'java',
-        'csharp': 'cs',
-        'html': 'html',
-        'css': 'css',
-        'ruby': 'rb',
-        'php': 'php',
-        'c': 'c',
-        'cpp': 'cpp',
-        'go': 'go',
-        'sql': 'sql',
-        'shell': 'sh',
-        'xml': 'xml',
-        'json': 'json',
-        'yaml': 'yaml',
-        'markdown': 'md',
-        'r': 'r',
-        'swift': 'swift',
-        'kotlin': 'kt'
-    }
+    """
+    Update the StoryMap content with the actual content from parsed blocks.
     
+    Only the nodes created for parsed blocks need updating, so the parsed blocks are
+    walked and each is dispatched to the updater for its type.
+    """
     replacements = 0
+    nodes = main_data['nodes']
     
     # Process each node
     log_message("Updating node content", "basic")
-    for node_id, node in main_data['nodes'].items():
-        log_message(f"Processing node: {node_id}, type: {node.get('type')}", "full")
+    for node_id, block in parsed_blocks.items():
+        node = nodes.get(node_id)
+        if node is None:
+            continue
+        if DEBUG_LEVEL_INT >= LEVEL_PRIORITY["full"]:
+            log_message("Processing node: %s, type: %s", "full", node_id, node.get('type'))
         
-        # Handle text nodes that need to be transformed to code nodes
-        if node.get('type') == 'text' and node_id in parsed_blocks:
-            block = parsed_blocks[node_id]
-            
-            # Check if this is a code block placeholder
-            if block.get('type') == 'code':
-                try:
-                    log_message(f"Transforming text node {node_id} to code node", "full")
-                    
-                    # Get the code content and language
-                    code_content = block.get('code', '')
-                    language = block.get('language', 'text').lower()
-                    mapped_language = language_mapping.get(language, 'txt')
-                    
-                    # Update the node type and data structure
-                    node['type'] = 'code'
-                    
-                    # Create proper code node data structure
-                    node['data'] = {
-                        'content': code_content,
-                        'lang': mapped_language,
-                        'lineNumbers': True
-                    }
-                    
-                    replacements += 1
-                    log_message(f"Successfully transformed node {node_id} to code node with language {mapped_language}", "full")
-                    continue
-                except Exception as e:
-                    log_message(f"Failed to transform text to code node {node_id}: {str(e)}", "basic", is_warning=True)
-        
-        # Process normal text nodes
-        if node.get('type') == 'text' and 'data' in node and 'text' in node['data']:
-            current_text = node['data']['text']
-            if current_text.startswith("PLACEHOLDER_TEXT_"):
-                # Try to find the matching content
-                if node_id in parsed_blocks:
-                    block = parsed_blocks[node_id]
-                    if block.get('type') == 'text':
-                        # Get the text content
-                        text_content = block.get('text', '')
-                        
-                        # Skip completely empty text nodes
-                        if not text_content or text_content.strip() == "" or text_content == "...":
-                            log_message(f"Skipping empty text block for node {node_id}", "basic")
-                            # Remove this node from the nodes collection
-                            main_data['nodes'].pop(node_id, None)
-                            log_message(f"Removed empty text node {node_id}", "basic")
-                            continue
-                        
-                        # Debug information
-                        log_message(f"For node {node_id}, replacing placeholder with text: '{text_content[:30]}...'", "full")
-                        
-                        # Ensure we have non-empty text to replace with
-                        if not text_content or text_content.strip() == "":
-                            # If the parsed text is empty, create a non-empty placeholder
-                            text_content = " "  # Single space
-                            log_message(f"Empty text content for node {node_id}, using space placeholder", "basic", is_warning=True)
-                        
-                        # Update the text content
-                        node['data']['text'] = text_content
-                        
-                        # Update alignment if present
-                        alignment = block.get('alignment')
-                        if alignment:
-                            alignment_map = {
-                                'center': 'center',
-                                'right': 'end',
-                                'justify': 'justify',
-                                'left': 'start'
-                            }
-                            if alignment in alignment_map:
-                                node['data']['textAlignment'] = alignment_map[alignment]
-                                log_message(f"Set text alignment to {alignment_map[alignment]}", "full")
-                        
-                        replacements += 1
-                        log_message(f"Replaced placeholder in node {node_id}", "full")
-        
-        # Update table content
-        elif node.get('type') == 'table' and 'data' in node:
-            if node_id in parsed_blocks:
-                block = parsed_blocks[node_id]
-                if block.get('type') == 'table':
-                    # Update table data with rows content
-                    rows = block.get('rows', [])
-                    num_rows = len(rows)
-                    num_cols = max(len(row) for row in rows) if rows else 0
-                    
-                    log_message(f"Updating table node {node_id} with {num_rows}x{num_cols} cells", "full")
-                    
-                    # Update table data
-                    node['data']['numRows'] = num_rows
-                    node['data']['numColumns'] = num_cols
-                    
-                    # Create cells structure
-                    if 'cells' not in node['data']:
-                        node['data']['cells'] = {}
-                    
-                    # Populate cells
-                    for row_idx, row in enumerate(rows):
-                        if str(row_idx) not in node['data']['cells']:
-                            node['data']['cells'][str(row_idx)] = {}
-                        
-                        for col_idx, cell_value in enumerate(row):
-                            if col_idx < num_cols:  # Ensure we don't exceed defined columns
-                                node['data']['cells'][str(row_idx)][str(col_idx)] = {
-                                    "value": cell_value
-                                }
-                    
-                    # Add caption if present
-                    if 'caption' in block and block['caption']:
-                        node['data']['caption'] = block['caption']
-                        log_message(f"Added caption to table: {block['caption'][:30]}...", "full")
-                    
-                    replacements += 1
-                    log_message(f"Updated table in node {node_id}", "full")
-                    
-        # Update image properties (caption and float alignment)
-        elif node.get('type') == 'image' and 'data' in node:
-            if node_id in parsed_blocks:
-                block = parsed_blocks[node_id]
-                
-                # Check if there's a caption
-                if 'caption' in block and block['caption']:
-                    node['data']['caption'] = block['caption']
-                    log_message(f"Added caption to image: {block['caption'][:30]}...", "full")
-                    replacements += 1
-                
-                # Apply float alignment if specified
-                if block.get('display') == 'float' and block.get('float_alignment'):
-                    if 'config' not in node:
-                        node['config'] = {}
-                    node['config']['size'] = 'float'
-                    node['config']['floatAlignment'] = block['float_alignment']
-                    log_message(f"Applied float alignment '{block['float_alignment']}' to image node {node_id}", "full")
-                    replacements += 1
+        updater = NODE_UPDATERS.get(block.get('type'))
+        if updater is not None:
+            replacements += updater(node_id, node, block, main_data)
     
     return replacements
 
@@ -2738,28 +2937,29 @@ def update_image_dimensions(main_data, parsed_blocks, image_dimensions):
     log_message("Updating image dimensions in resources section", "basic")
     images_updated = 0
     
+    # Index the image nodes by the resource they reference, in node order
+    image_nodes_by_resource = {}
+    for node_id, node in main_data['nodes'].items():
+        if node.get('type') == 'image' and 'data' in node and 'image' in node['data']:
+            image_nodes_by_resource.setdefault(node['data']['image'], []).append(node_id)
+    
     for resource_id, resource in main_data['resources'].items():
         if resource.get('type') == 'image' and 'data' in resource:
             # Find the matching image in resource data by filename
             if 'resourceId' in resource['data']:
                 filename = resource['data'].get('resourceId', '')
-                log_message(f"Processing resource: {resource_id}, resourceId: {filename}", "full")
+                log_message("Processing resource: %s, resourceId: %s", "full", resource_id, filename)
                 
                 # Look for image nodes with this resource
-                for node_id, node in main_data['nodes'].items():
-                    if node.get('type') == 'image' and 'data' in node and 'image' in node['data']:
-                        image_ref = node['data']['image']
-                        
-                        # If this node references this resource
-                        if image_ref == resource_id:
-                            # Find corresponding image in parsed_blocks
-                            if node_id in parsed_blocks and 'dimensions' in parsed_blocks[node_id]:
-                                width, height = parsed_blocks[node_id]['dimensions']
-                                resource['data']['width'] = width
-                                resource['data']['height'] = height
-                                images_updated += 1
-                                log_message(f"Updated resource {resource_id} with dimensions {width}x{height}", "full")
-                                break
+                for node_id in image_nodes_by_resource.get(resource_id, ()):
+                    # Find corresponding image in parsed_blocks
+                    if node_id in parsed_blocks and 'dimensions' in parsed_blocks[node_id]:
+                        width, height = parsed_blocks[node_id]['dimensions']
+                        resource['data']['width'] = width
+                        resource['data']['height'] = height
+                        images_updated += 1
+                        log_message("Updated resource %s with dimensions %sx%s", "full", resource_id, width, height)
+                        break
     
     return images_updated
 
@@ -2774,28 +2974,24 @@ def save_storymap_updates(storymap_item, main_data):
     # 2. Update the draft file
     log_message("Retrieving draft file name...", "full")
     resources = storymap_item.resources.list()
-    draft_file_name = None
-    
-    for resource in resources:
-        if isinstance(resource, dict) and 'resource' in resource:
-            if resource['resource'].startswith('draft_'):
-                draft_file_name = resource['resource']
-                break
+    draft_file_name = next(
+        (resource['resource'] for resource in resources
+         if isinstance(resource, dict) and resource.get('resource', '').startswith('draft_')),
+        None
+    )
     
     if not draft_file_name:
         log_message("Draft file not found. Only main data was updated.", "basic", is_warning=True)
         return True
     
-    log_message(f"Found draft file: {draft_file_name}", "full")
-    
-    # Write the updated data to a temporary file
-    import requests
-    import tempfile
+    log_message("Found draft file: %s", "full", draft_file_name)
     
-    draft_file_path = os.path.join(tempfile.gettempdir(), draft_file_name)
-    
-    with open(draft_file_path, "w", encoding="utf-8") as draft_file:
-        json.dump(main_data, draft_file, ensure_ascii=False, indent=2)
+    # Serialize the updated data in memory, the server does not need it indented
+    try:
+        draft_json = dump_storymap_json(main_data, indent=False)
+    except Exception as e:
+        log_message("Failed to serialize draft file: %s", "none", e, is_error=True)
+        return False
     
     # Upload using direct REST API call
     log_message("Uploading modified draft file...", "basic")
@@ -2808,15 +3004,14 @@ def save_storymap_updates(storymap_item, main_data):
         "token": storymap_item._gis._con.token,
     }
     
-    with open(draft_file_path, "rb") as draft_file:
-        files = {"file": draft_file}
-        response = requests.post(update_url, data=params, files=files)
+    files = {"file": (draft_file_name, draft_json)}
+    response = HTTP_SESSION.post(update_url, data=params, files=files)
     
     if response.status_code == 200 and response.json().get("success"):
         log_message("Modified draft file uploaded successfully", "basic")
         return True
     else:
-        log_message(f"Failed to upload modified draft file. Response: {response.text}", "basic", is_error=True)
+        log_message("Failed to upload modified draft file. Response: %s", "basic", response.text, is_error=True)
         return False
 
         
@@ -2840,7 +3035,7 @@ def create_text_block(text_type, text_content, alignment=None):
             'textAlignment': alignment
         }
     
-    log_message(f"Created text block of type {text_type}", "full")
+    log_message("Created text block of type %s", "full", text_type)
     return block
 
 def create_image_block(image_path, caption=None, display=None, float_alignment=None):
@@ -2852,7 +3047,7 @@ def create_image_block(image_path, caption=None, display=None, float_alignment=N
         'display': display,
         'float_alignment': float_alignment
     }
-    log_message(f"Created image block from {os.path.basename(image_path)} with display:{display}, alignment:{float_alignment}", "full")
+    log_message("Created image block from %s with display:%s, alignment:%s", "full", os.path.basename(image_path), display, float_alignment)
     return block
 
 
@@ -2863,7 +3058,7 @@ def create_table_block(rows, caption=None):
         'rows': rows,
         'caption': caption
     }
-    log_message(f"Created table block with {len(rows)} rows", "full")
+    log_message("Created table block with %s rows", "full", len(rows))
     return block
 
 def create_code_block(code_content, language=None):
@@ -2873,14 +3068,14 @@ def create_code_block(code_content, language=None):
     """
     if language is None or language == 'text':
         language = detect_code_language(code_content)
-        log_message(f"Auto-detected code language: {language}", "full")
+        log_message("Auto-detected code language: %s", "full", language)
     
     block = {
         'type': 'code',
         'code': code_content,
         'language': language
     }
-    log_message(f"Created code block with language {language}", "full")
+    log_message("Created code block with language %s", "full", language)
     return block
 
 
@@ -2892,250 +3087,190 @@ def create_separator_block():
     log_message("Created separator block", "full")
     return block
 
-def sanitize_html(html_text, allowed_tags=None):
-    """Sanitize HTML to only include allowed tags."""
-    if allowed_tags is None:
-        # Expand allowed tags to include more formatting options
-        allowed_tags = ['strong', 'em', 'a', 'span', 'u', 's', 'sub', 'sup', 'ul', 'ol', 'li']
-    
-    # Basic sanitization - preserve all allowed tags
-    import re
-    
-    # First, replace all occurrences of <br> or <br/> with newlines
-    html_text = re.sub(r'<br\s*/?>', '\n', html_text)
-    
-    # For each disallowed tag, replace the opening and closing tags with empty strings
-    for tag in re.findall(r'</?([a-z][a-z0-9]*)', html_text, re.IGNORECASE):
-        tag = tag.lower()
-        if tag not in allowed_tags:
-            html_text = re.sub(f'</?{tag}[^>]*>', '', html_text)
-    
-    log_message(f"Sanitized HTML, allowed tags: {', '.join(allowed_tags)}", "full")
-    return html_text
-    
-
-
 
+@lru_cache(maxsize=1024)
 def detect_code_language(code_content):
     """
     Detect the programming language of a code snippet using pattern recognition.
     
+    The result depends only on the snippet text, so repeated snippets are answered
+    from the cache.
+    
     Args:
         code_content (str): The code snippet to analyze
         
     Returns:
         str: The detected language code (compatible with StoryMap API)
     """
-    import re
-    import json
-    
     # Debug header
-    log_message(f"Detecting code language for snippet: '{code_content[:50]}...'", "full")
+    log_message("Detecting code language for snippet: '%s...'", "full", code_content[:50])
+    
+    # Prepare the code for analysis
+    code = code_content.strip() if code_content else ''
     
     # Default to plain text if we can't identify the language
-    if not code_content or len(code_content.strip()) < 3:
+    if len(code) < 3:
         log_message("Code too short - returning txt", "full")
         return 'txt'
     
-    # Prepare the code for analysis
-    code = code_content.strip()
     code_lower = code.lower()
     
     # Check each language in priority order
-    lang = check_sql(code, code_lower)
+    lang = check_sql(code_lower)
     if lang: 
-        log_message(f"Detected language: {lang} (SQL check)", "full")
+        log_message("Detected language: %s (SQL check)", "full", lang)
         return lang
     
-    lang = check_arcade(code, code_lower)
+    lang = check_arcade(code)
     if lang: 
-        log_message(f"Detected language: {lang} (Arcade check)", "full")
+        log_message("Detected language: %s (Arcade check)", "full", lang)
         return lang
     
     lang = check_json(code)
     if lang: 
-        log_message(f"Detected language: {lang} (JSON check)", "full")
+        log_message("Detected language: %s (JSON check)", "full", lang)
         return lang
     
-    lang = check_python(code, code_lower)
+    lang = check_python(code)
     if lang: 
-        log_message(f"Detected language: {lang} (Python check)", "full")
+        log_message("Detected language: %s (Python check)", "full", lang)
         return lang
     
-    lang = check_csharp(code, code_lower)
+    lang = check_csharp(code)
     if lang: 
-        log_message(f"Detected language: {lang} (C# check)", "full")
+        log_message("Detected language: %s (C# check)", "full", lang)
         return lang
     
-    lang = check_javascript_typescript(code, code_lower)
+    lang = check_javascript_typescript(code)
     if lang: 
-        log_message(f"Detected language: {lang} (JS/TS check)", "full")
+        log_message("Detected language: %s (JS/TS check)", "full", lang)
         return lang
     
-    lang = check_css(code, code_lower)
+    lang = check_css(code)
     if lang: 
-        log_message(f"Detected language: {lang} (CSS check)", "full")
+        log_message("Detected language: %s (CSS check)", "full", lang)
         return lang
     
-    lang = check_html(code, code_lower)
+    lang = check_html(code)
     if lang: 
-        log_message(f"Detected language: {lang} (HTML check)", "full")
+        log_message("Detected language: %s (HTML check)", "full", lang)
         return lang
     
     # Fallback to keyword matching
-    lang = check_keywords(code, code_lower)
+    lang = check_keywords(code_lower)
     if lang: 
-        log_message(f"Detected language: {lang} (keyword check)", "full")
+        log_message("Detected language: %s (keyword check)", "full", lang)
         return lang
     
     # Special case: text about code
-    lang = check_text_about_code(code, code_lower)
+    lang = check_text_about_code(code_lower)
     if lang: 
-        log_message(f"Detected language: {lang} (text about code check)", "full")
+        log_message("Detected language: %s (text about code check)", "full", lang)
         return lang
     
     # Fallback to plain text
     log_message("No confident match found, using text as fallback", "full")
     return 'txt'
 
-def check_sql(code, code_lower):
+def check_sql(code_lower):
     """Check if the code is SQL."""
-    sql_patterns = [
-        (r'SELECT\s+.+?\s+FROM', "SELECT FROM"),
-        (r'INSERT\s+INTO', "INSERT INTO"),
-        (r'UPDATE\s+.+?\s+SET', "UPDATE SET"),
-        (r'CREATE\s+TABLE', "CREATE TABLE"),
-        (r'ALTER\s+TABLE', "ALTER TABLE"),
-        (r'DROP\s+TABLE', "DROP TABLE"),
-        (r'JOIN\s+\w+\s+ON', "JOIN ON"),
-        (r'WHERE\s+\w+\s*[=<>]', "WHERE clause"),
-        (r'ORDER\s+BY\s+\w+', "ORDER BY"),
-        (r'GROUP\s+BY\s+\w+', "GROUP BY")
-    ]
-    
-    matches = 0
-    for pattern, description in sql_patterns:
-        if re.search(pattern, code_lower, re.IGNORECASE | re.MULTILINE):
-            matches += 1
-            log_message(f"SQL match: {description}", "full")
-    
-    if matches >= 1:
-        return 'sql'
+    if not SQL_PREFILTER.search(code_lower):
+        return None
+    
+    # A single matching pattern is enough
+    for pattern, description in SQL_PATTERNS:
+        if pattern.search(code_lower):
+            log_message("SQL match: %s", "full", description)
+            return 'sql'
     return None
 
-def check_arcade(code, code_lower):
+def check_arcade(code):
     """Check if the code is Arcade."""
-    arcade_patterns = [
-        (r'Geometry\(', "Arcade Geometry constructor"),
-        (r'(Feature|FeatureSet)\(', "Arcade Feature constructor"),
-        (r'When\(', "Arcade When function"),
-        (r'(Text|Count|Concatenate|IIf|IsEmpty)\(', "Arcade functions"),
-        (r'\$feature', "Arcade feature reference"),
-        (r'\$map', "Arcade map reference"),
-        (r'//.*$', "Arcade comment")
-    ]
-    
-    matches = 0
-    for pattern, description in arcade_patterns:
-        if re.search(pattern, code, re.IGNORECASE | re.MULTILINE):
-            matches += 1
-            log_message(f"Arcade match: {description}", "full")
-    
-    if matches >= 1:
-        return 'arcade'
+    if not ARCADE_PREFILTER.search(code):
+        return None
+    
+    # A single matching pattern is enough
+    for pattern, description in ARCADE_PATTERNS:
+        if pattern.search(code):
+            log_message("Arcade match: %s", "full", description)
+            return 'arcade'
     return None
 
 def check_json(code):
     """Check if the code is valid JSON."""
+    code = code.strip()
+    if not ((code.startswith('{') and code.endswith('}')) or
+            (code.startswith('[') and code.endswith(']'))):
+        return None
+    
+    # A non-empty JSON object always has a colon, skip parsing code blocks in braces
+    if code[0] == '{' and ':' not in code and code[1:-1].strip():
+        return None
+    
     try:
-        if (code.strip().startswith('{') and code.strip().endswith('}')) or \
-           (code.strip().startswith('[') and code.strip().endswith(']')):
+        if orjson is None:
             json.loads(code)
-            log_message("Valid JSON structure detected", "full")
-            return 'json'
+        else:
+            # orjson is faster, anything it rejects is retried with json as in get_storymap_data
+            try:
+                orjson.loads(code)
+            except ValueError:
+                json.loads(code)
+        log_message("Valid JSON structure detected", "full")
+        return 'json'
     except:
         pass
     return None
 
-def check_python(code, code_lower):
+def check_python(code):
     """Check if the code is Python."""
-    python_patterns = [
-        (r'\bdef\s+\w+\s*\(', "Function definition"),
-        (r'\bclass\s+\w+\s*:', "Class definition"),
-        (r'import\s+[\w.]+', "Import statement"),
-        (r'from\s+[\w.]+\s+import', "From import"),
-        (r'if\s+__name__\s*==\s*[\'"]__main__[\'"]', "Main block"),
-        (r'arcpy\.\w+', "ArcPy call"),
-        (r'#.*?$', "Python comment")
-    ]
-    
-    matches = 0
-    for pattern, description in python_patterns:
-        if re.search(pattern, code, re.IGNORECASE | re.MULTILINE):
-            matches += 1
-            log_message(f"Python match: {description}", "full")
-    
-    if matches >= 1:
-        return 'py'
+    if not PYTHON_PREFILTER.search(code):
+        return None
+    
+    # A single matching pattern is enough
+    for pattern, description in PYTHON_PATTERNS:
+        if pattern.search(code):
+            log_message("Python match: %s", "full", description)
+            return 'py'
     return None
 
-def check_csharp(code, code_lower):
+def check_csharp(code):
     """Check if the code is C#."""
-    csharp_patterns = [
-        (r'using\s+System;', "Using System"),
-        (r'namespace\s+\w+', "Namespace declaration"),
-        (r'(public|private|protected)\s+(class|interface)', "Class/interface declaration"),
-        (r'(public|private|protected)\s+\w+\s+\w+\s*\(', "Method declaration"),
-        (r'Console\.(Write|WriteLine)', "Console output")
-    ]
-    
-    matches = 0
-    for pattern, description in csharp_patterns:
-        if re.search(pattern, code, re.IGNORECASE | re.MULTILINE):
-            matches += 1
-            log_message(f"C# match: {description}", "full")
-    
-    if matches >= 1:
-        return 'cs'
+    if not CSHARP_PREFILTER.search(code):
+        return None
+    
+    # A single matching pattern is enough
+    for pattern, description in CSHARP_PATTERNS:
+        if pattern.search(code):
+            log_message("C# match: %s", "full", description)
+            return 'cs'
     return None
 
-def check_javascript_typescript(code, code_lower):
+def check_javascript_typescript(code):
     """Check if the code is JavaScript or TypeScript."""
-    js_patterns = [
-        (r'function\s+\w+\s*\(', "Function declaration"),
-        (r'(const|let|var)\s+\w+\s*=', "Variable declaration"),
-        (r'=>', "Arrow function"),
-        (r'console\.(log|warn|error)', "Console statement"),
-        (r'document\.get(Element|ElementsByTagName)', "DOM manipulation"),
-        (r'window\.\w+', "Window object"),
-        (r'new\s+\w+\(', "Constructor call")
-    ]
+    if not JS_PREFILTER.search(code):
+        return None
     
+    # Only whether any pattern matches is used, so each loop stops at the first match
     js_matches = 0
-    for pattern, description in js_patterns:
-        if re.search(pattern, code, re.IGNORECASE | re.MULTILINE):
+    for pattern, description in JS_PATTERNS:
+        if pattern.search(code):
             js_matches += 1
-            log_message(f"JavaScript match: {description}", "full")
+            log_message("JavaScript match: %s", "full", description)
+            break
     
     # Check TypeScript
-    ts_patterns = [
-        (r'interface\s+\w+', "Interface"),
-        (r'type\s+\w+\s*=', "Type definition"),
-        (r':\s*\w+[\[\]<>]*(\s*=|\))', "Type annotation"),
-        (r'<\w+>[\(\[]', "Generic"),
-        (r'as\s+\w+', "Type assertion")
-    ]
-    
     ts_matches = 0
-    for pattern, description in ts_patterns:
-        if re.search(pattern, code, re.IGNORECASE | re.MULTILINE):
+    for pattern, description in TS_PATTERNS:
+        if pattern.search(code):
             ts_matches += 1
-            log_message(f"TypeScript match: {description}", "full")
+            log_message("TypeScript match: %s", "full", description)
+            break
     
     # Determine if it's JS, TS, JSX, or TSX
     if js_matches >= 1 or ts_matches >= 1:
         # Check if it contains HTML-like syntax
-        has_html = bool(re.search(r'<\w+(\s+\w+=["\'].+?["\'])*>', code))
+        has_html = bool(JSX_ELEMENT_PATTERN.search(code))
         
         if has_html:
             if ts_matches >= 1:
@@ -3148,97 +3283,70 @@ def check_javascript_typescript(code, code_lower):
             return 'js'
     return None
 
-def check_css(code, code_lower):
+def check_css(code):
     """Check if the code is CSS."""
     if '{' in code and ('}' in code or ';' in code):
-        css_patterns = [
-            (r'[\w-]+\s*:\s*[^;]+;', "Property:value"),
-            (r'\.\w+[\w-]*\s*\{', "Class selector"),
-            (r'#\w+[\w-]*\s*\{', "ID selector"),
-            (r'@(media|keyframes|import|font-face)', "CSS at-rule"),
-            (r'(margin|padding|color|background|font|display):', "Common CSS property")
-        ]
-        
         matches = 0
-        for pattern, description in css_patterns:
-            if re.search(pattern, code, re.IGNORECASE):
+        for pattern, description in CSS_PATTERNS:
+            if pattern.search(code):
                 matches += 1
-                log_message(f"CSS match: {description}", "full")
+                log_message("CSS match: %s", "full", description)
+                # Two matches always count as CSS
+                if matches == 2:
+                    break
         
         if matches >= 2 or (matches >= 1 and len(code) < 100):
             return 'css'
     return None
 
-def check_html(code, code_lower):
+def check_html(code):
     """Check if the code is HTML."""
     if '<' in code and '>' in code:
-        # Count HTML tags (both opening and closing)
-        tag_pattern = r'</?[a-z][a-z0-9]*\b[^>]*>'
-        tags = re.findall(tag_pattern, code, re.IGNORECASE)
-        
-        # Count angle brackets
-        open_brackets = code.count('<')
-        close_brackets = code.count('>')
+        # Count HTML tags (both opening and closing), only up to the two that decide
+        tag_count = sum(1 for _ in islice(HTML_TAG_PATTERN.finditer(code), 2))
         
-        # Common HTML attribute pattern
-        attr_pattern = r'\s+(href|src|alt|class|id|style)=["\'"][^\'"]*["\']'
-        attrs = re.findall(attr_pattern, code, re.IGNORECASE)
+        # Common HTML attribute pattern, only needed for a single tag
+        has_attrs = tag_count == 1 and HTML_ATTR_PATTERN.search(code) is not None
         
-        log_message(f"HTML tags found: {len(tags)}, attributes: {len(attrs)}", "full")
+        log_message("HTML tags found (up to 2): %s, attributes: %s", "full", tag_count, has_attrs)
         
         # If we have at least 2 tags or 1 tag with attributes, it's likely HTML
-        if len(tags) >= 2 or (len(tags) >= 1 and len(attrs) >= 1):
+        if tag_count >= 2 or has_attrs:
             # Check for balanced brackets as additional confidence
-            if abs(open_brackets - close_brackets) <= 2:
-                log_message(f"HTML detected with {len(tags)} tags and {len(attrs)} attributes", "full")
+            if abs(code.count('<') - code.count('>')) <= 2:
+                log_message("HTML detected with %s tags, attributes: %s", "full", tag_count, has_attrs)
                 return 'html'
                 
         # Specific HTML pattern checks for additional confidence
-        html_patterns = [
-            (r'<!DOCTYPE\s+html', "HTML doctype"),
-            (r'<html>|<html\s+', "HTML root tag"),
-            (r'<(div|span|p|a|img|h[1-6])(\s+[^>]*)?>', "Common HTML tag")
-        ]
-        
-        for pattern, description in html_patterns:
-            if re.search(pattern, code, re.IGNORECASE):
-                log_message(f"Strong HTML pattern match: {description}", "full")
+        for pattern, description in HTML_PATTERNS:
+            if pattern.search(code):
+                log_message("Strong HTML pattern match: %s", "full", description)
                 return 'html'
     return None
 
-def check_keywords(code, code_lower):
+def check_keywords(code_lower):
     """Check for language-specific keywords."""
-    keyword_sets = {
-        'py': ['def', 'import', 'class', 'self', 'None', 'True', 'False', 'if', 'elif', 'else', 'for', 'in', 'try', 'except'],
-        'js': ['function', 'const', 'let', 'var', 'return', 'true', 'false', 'null', 'undefined', 'this', 'new'],
-        'sql': ['select', 'from', 'where', 'insert', 'update', 'delete', 'create', 'drop', 'alter', 'join'],
-        'cs': ['using', 'namespace', 'public', 'private', 'class', 'void', 'string', 'int', 'bool'],
-        'html': ['div', 'span', 'class', 'id', 'style', 'href', 'src'],
-        'css': ['margin', 'padding', 'color', 'background', 'width', 'height', 'font'],
-        'arcade': ['when', 'feature', 'geometry', 'text', 'count', 'iif']
-    }
-    
     # Count occurrences of keywords for each language
     language_scores = {}
-    words = re.findall(r'\b(\w+)\b', code_lower)
+    word_counts = Counter(KEYWORD_WORD_PATTERN.findall(code_lower))
     
-    for lang, keywords in keyword_sets.items():
-        matches = sum(1 for word in words if word in keywords)
+    for lang, keywords in LANGUAGE_KEYWORDS.items():
+        matches = sum(word_counts[keyword] for keyword in keywords)
         if matches > 0:
             language_scores[lang] = matches
-            log_message(f"Keyword matches for {lang}: {matches}", "full")
+            log_message("Keyword matches for %s: %s", "full", lang, matches)
     
     if language_scores:
-        best_match = max(language_scores.items(), key=lambda x: x[1])
+        best_match = max(language_scores.items(), key=itemgetter(1))
         lang, score = best_match
         
         # Only use keyword detection if we have enough matches
         if score >= 2:
-            log_message(f"Best language match based on keywords: {lang} with {score} matches", "full")
+            log_message("Best language match based on keywords: %s with %s matches", "full", lang, score)
             return lang
     return None
 
-def check_text_about_code(code, code_lower):
+def check_text_about_code(code_lower):
     """Check if this is text about code rather than code itself."""
     if ('code' in code_lower and ('style' in code_lower or 'add' in code_lower)) or \
        ('syntax' in code_lower or 'example' in code_lower):
@@ -3259,26 +3367,6 @@ def check_text_about_code(code, code_lower):
             return 'cs'
     return None
 
-def format_link_for_storymap(url, link_text):
-    """
-    Format links consistently for StoryMap.
-    Ensures links open in a new tab and use the actual URL from Word.
-    
-    Args:
-        url: The URL for the link
-        link_text: The text to display for the link
-        
-    Returns:
-        Properly formatted HTML link tag
-    """
-    # Make sure URL is properly formed
-    if url and not url.startswith(('http://', 'https://', '#')):
-        url = 'https://' + url
-        
-    # Create a properly formatted link that opens in a new tab
-    return f'<a href="{url}" rel="noopener noreferrer" target="_blank">{link_text}</a>'
-    
 
-    
 if __name__ == "__main__":
     main()
\ No newline at end of file